@@ -0,0 +1,852 @@
+"""Бенчмарки trader.py без сети.
+
+OpenAI Assistants и Telegram подменяются фейками внутри процесса, поэтому
+ключи не нужны. Все файлы бота (users.json, журнал, логи) создаются во
+временной директории.
+
+Примеры:
+    python bench.py chats --chats 50 --messages 3 --latency 0.2
+    python bench.py trade --players 300 --messages 5 --json
+    python bench.py memory --items 100000
+    python bench.py duplicates --items 100000
+    python bench.py workers --workers 4 --players 400
+    python bench.py send --chats 100 --naive
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from types import SimpleNamespace
+
+# trader.py читает и пишет файлы в текущей директории — уводим их во временную
+# (процессы сценария workers работают в директории родителя)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.environ.get("SHIFTTRADER_BENCH_DIR") or tempfile.mkdtemp(prefix="shifttrader_bench_"))
+
+import trader  # noqa: E402
+from telegram.error import BadRequest, RetryAfter, TelegramError  # noqa: E402
+
+
+# ------------------------------------------------------------------------------
+# Фейковый AsyncOpenAI: client.beta.threads
+# ------------------------------------------------------------------------------
+class FakePage:
+    """Результат messages.list: можно и await-ить (страница), и обходить async for."""
+
+    def __init__(self, backend, data):
+        self.backend = backend
+        self.data = data
+
+    def __await__(self):
+        return self._page().__await__()
+
+    async def _page(self):
+        await self.backend.delay()
+        return SimpleNamespace(data=self.data)
+
+    async def __aiter__(self):
+        await self.backend.delay()
+        for message in self.data:
+            yield message
+
+
+class FakeMessages:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def create(self, thread_id, role, content):
+        await self.backend.delay()
+        message = self.backend.make_message(role, content)
+        self.backend.threads[thread_id].append(message)
+        return message
+
+    def list(self, thread_id, after=None, order="desc", limit=20, **kwargs):
+        messages = self.backend.threads[thread_id]
+        if order == "desc":
+            messages = list(reversed(messages))
+        if after is not None:
+            ids = [message.id for message in messages]
+            messages = messages[ids.index(after) + 1:]
+        return FakePage(self.backend, messages[:limit])
+
+
+class FakeStream:
+    """Асинхронный стрим событий run, как у AsyncAssistantStreamManager.
+
+    Ход run задаёт backend.assistant: генератор, который по тексту игрока отдаёт
+    пачки tool calls (и получает их результаты), а в конце возвращает ответ.
+    Стрим нового run начинается с run.created, стрим после submit_tool_outputs —
+    продолжает тот же run; каждый заканчивается requires_action или completed.
+    """
+
+    def __init__(self, backend, thread_id, run=None, tool_outputs=None):
+        self.backend = backend
+        self.thread_id = thread_id
+        self.run = run
+        self.tool_outputs = tool_outputs
+
+    async def __aenter__(self):
+        await self.backend.delay()
+        return self._events()
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def _events(self):
+        run = self.run
+        try:
+            if run is None:
+                run = self.backend.start_run(self.thread_id)
+                yield SimpleNamespace(event="thread.run.created", data=run)
+                calls = next(run.plan)
+            else:
+                outputs = [json.loads(output["output"]) for output in self.tool_outputs]
+                calls = run.plan.send(outputs)
+        except StopIteration as stop:
+            reply = stop.value
+        else:
+            await asyncio.sleep(self.backend.tool_call_time)
+            run.status = "requires_action"
+            run.required_action = self.backend.make_required_action(calls)
+            yield SimpleNamespace(event="thread.run.requires_action", data=run)
+            return
+
+        await asyncio.sleep(self.backend.generation_time)
+        message = self.backend.make_message("assistant", reply)
+        self.backend.threads[self.thread_id].append(message)
+        yield SimpleNamespace(event="thread.message.completed", data=message)
+        run.status = "completed"
+        run.usage = SimpleNamespace(prompt_tokens=run.prompt_tokens, completion_tokens=len(reply) // 4 + 1)
+        yield SimpleNamespace(event="thread.run.completed", data=run)
+
+
+class FakeRuns:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def stream(self, thread_id, assistant_id, **kwargs):
+        return FakeStream(self.backend, thread_id)
+
+    def submit_tool_outputs_stream(self, thread_id, run_id, tool_outputs):
+        return FakeStream(self.backend, thread_id, self.backend.runs[run_id], tool_outputs)
+
+    async def cancel(self, thread_id, run_id):
+        await self.backend.delay()
+        run = self.backend.runs[run_id]
+        run.status = "cancelled"
+        return run
+
+
+class FakeThreads:
+    def __init__(self, backend):
+        self.backend = backend
+        self.messages = FakeMessages(backend)
+        self.runs = FakeRuns(backend)
+
+    async def create(self, messages=()):
+        await self.backend.delay()
+        thread_id = f"thread_{next(self.backend.ids)}"
+        self.backend.threads[thread_id] = [self.backend.make_message(m["role"], m["content"]) for m in messages]
+        return SimpleNamespace(id=thread_id)
+
+    async def retrieve(self, thread_id):
+        await self.backend.delay()
+        return SimpleNamespace(id=thread_id)
+
+
+def plain_assistant(text):
+    """Отвечает, не вызывая инструментов."""
+    yield from ()
+    return "Ответ Менялы"
+
+
+class FakeOpenAI:
+    """Подмена AsyncOpenAI: каждый вызов API занимает latency секунд.
+
+    generation_time — сколько ассистент пишет ответ, tool_call_time — сколько
+    он «думает» перед очередной пачкой tool calls.
+    """
+
+    def __init__(self, latency, generation_time, assistant=plain_assistant, tool_call_time=0.0):
+        self.latency = latency
+        self.generation_time = generation_time
+        self.tool_call_time = tool_call_time
+        self.assistant = assistant
+        self.threads = {}
+        self.runs = {}
+        self.ids = itertools.count(1)
+        self.beta = SimpleNamespace(threads=FakeThreads(self))
+
+    async def delay(self):
+        await asyncio.sleep(self.latency)
+
+    def start_run(self, thread_id):
+        messages = self.threads[thread_id]
+        text = next(m.content[0].text.value for m in reversed(messages) if m.role == "user")
+        run = SimpleNamespace(
+            id=f"run_{next(self.ids)}",
+            status="in_progress",
+            usage=None,
+            last_error=None,
+            required_action=None,
+            plan=self.assistant(text),
+            prompt_tokens=sum(len(m.content[0].text.value) for m in messages[-4:]) // 4 + 1,
+        )
+        self.runs[run.id] = run
+        return run
+
+    def make_required_action(self, calls):
+        tool_calls = [
+            SimpleNamespace(
+                id=f"call_{next(self.ids)}",
+                function=SimpleNamespace(name=name, arguments=json.dumps(arguments, ensure_ascii=False))
+            )
+            for name, arguments in calls
+        ]
+        return SimpleNamespace(submit_tool_outputs=SimpleNamespace(tool_calls=tool_calls))
+
+    def make_message(self, role, content):
+        return SimpleNamespace(
+            id=f"msg_{next(self.ids)}",
+            role=role,
+            content=[SimpleNamespace(text=SimpleNamespace(value=content))]
+        )
+
+
+# ------------------------------------------------------------------------------
+# Фейковый Telegram
+# ------------------------------------------------------------------------------
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeBot:
+    """bot.send_message; с limits=True ведёт себя как Телеграм при флуде.
+
+    Больше BOT_LIMIT сообщений за секунду от бота или CHAT_LIMIT в один чат —
+    RetryAfter, длиннее TELEGRAM_MESSAGE_LIMIT — BadRequest.
+    """
+
+    BOT_LIMIT = 30
+    CHAT_LIMIT = 4
+
+    def __init__(self, latency=0.0, limits=False, flood_probability=0.0, rng=None):
+        self.latency = latency
+        self.limits = limits
+        self.flood_probability = flood_probability
+        self.rng = rng or random.Random()
+        self.recent = deque()
+        self.recent_per_chat = {}
+        self.delivered = {}
+        self.calls = 0
+        self.too_many = 0
+        self.too_long = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.limits:
+            if trader.telegram_length(text) > trader.TELEGRAM_MESSAGE_LIMIT:
+                self.too_long += 1
+                raise BadRequest("Message is too long")
+            now = time.monotonic()
+            chat_recent = self.recent_per_chat.setdefault(chat_id, deque())
+            for recent in (self.recent, chat_recent):
+                while recent and recent[0] <= now - 1:
+                    recent.popleft()
+            if (len(self.recent) >= self.BOT_LIMIT or len(chat_recent) >= self.CHAT_LIMIT
+                    or self.rng.random() < self.flood_probability):
+                self.too_many += 1
+                raise RetryAfter(1)
+            self.recent.append(now)
+            chat_recent.append(now)
+        self.delivered.setdefault(chat_id, []).append(text)
+
+
+def make_update(chat_id, text):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=FakeMessage(text))
+
+
+def make_context(client):
+    # Сценарии с run не упираются в лимиты Телеграма — их меряет сценарий send
+    unlimited = 1e9
+    trader.send_queue = trader.SendQueue(unlimited, unlimited, unlimited, unlimited)
+    return SimpleNamespace(bot=FakeBot(), application=SimpleNamespace(bot_data={"openai_client": client}))
+
+
+# ------------------------------------------------------------------------------
+# Сценарии
+# ------------------------------------------------------------------------------
+def create_players(count, balance=0):
+    """Регистрирует игроков; потоки создадутся при первом сообщении."""
+    chat_ids = []
+    for i in range(count):
+        chat_id = str(100000 + i)
+        if not trader.get_user(chat_id):
+            trader.create_user(chat_id, f"Игрок {i}")
+            if balance:
+                trader.update_balance(chat_id, balance)
+        chat_ids.append(chat_id)
+    return chat_ids
+
+
+async def player_session(chat_id, context, messages):
+    for i in range(messages):
+        await trader.handle_text_message(make_update(chat_id, f"Сообщение {i}"), context)
+
+
+async def bench_chats(args):
+    """N чатов одновременно пишут боту; меряем пропускную способность."""
+    trader.run_scheduler.max_concurrent = args.max_concurrent_runs
+    client = FakeOpenAI(args.latency, args.generation_time)
+    context = make_context(client)
+    chat_ids = create_players(args.chats)
+
+    started = time.perf_counter()
+    if args.sequential:
+        for chat_id in chat_ids:
+            await player_session(chat_id, context, args.messages)
+    else:
+        await asyncio.gather(*(player_session(chat_id, context, args.messages) for chat_id in chat_ids))
+    await trader.send_queue.join()
+    elapsed = time.perf_counter() - started
+
+    total = args.chats * args.messages
+    print(f"Чатов: {args.chats}, сообщений: {total}, режим: {'последовательно' if args.sequential else 'параллельно'}")
+    print(f"Время: {elapsed:.2f} с, пропускная способность: {total / elapsed:.1f} сообщений/с")
+    print(f"Очередь run: {trader.run_scheduler.metrics()}")
+    stages = trader.run_metrics.snapshot()["stages"]
+    for stage in trader.RUN_STAGES:
+        print(f"  {stage:<13} p50 {stages[stage]['p50']:.2f} с, p99 {stages[stage]['p99']:.2f} с")
+
+
+WORDS = ("магия неомаг судья трон территория артефакт заклинание дисциплина волшебник "
+         "существо место щель цифровой дар тайна клан договор сила ритуал").split()
+
+
+SELL_RE = re.compile(r"Продаю в категорию (\d+) за (\d+)\. (.+?)\. (.+)", re.S)
+SELLABLE_CATEGORIES = (2, 3, 4, 5, 6)
+
+
+def trade_assistant(text):
+    """Ассистент-Меняла для сценария trade: понимает фразы из trade_message."""
+    if text.startswith("Какие категории"):
+        categories, = yield [("get_categories_with_counts", {})]
+        return "Категории: " + ", ".join(f"{c['name']} ({c['count']})" for c in categories)
+    match = re.match(r"Покажи категорию (\d+)", text)
+    if match:
+        page, = yield [("get_items_for_category", {"category_id": int(match.group(1))})]
+        return f"В категории {len(page['items'])} записей" + (", есть ещё" if "next_cursor" in page else "")
+    match = re.match(r"Куплю что-нибудь из категории (\d+)", text)
+    if match:
+        category_id = int(match.group(1))
+        # Просмотр категории вместе с балансом покупок — параллельные read-only вызовы
+        page, _ = yield [("get_items_for_category", {"category_id": category_id}),
+                         ("get_user_purchase_history", {"limit": 5})]
+        if isinstance(page, str) or not page["items"]:
+            return "Здесь пока ничего нет"
+        cheapest = min(page["items"], key=lambda item: item["cost"])
+        result, = yield [("buy_item", {"category_id": category_id, "item_id": cheapest["id"]})]
+        return result
+    match = SELL_RE.match(text)
+    if match:
+        category_id, cost, description, details = match.groups()
+        result, = yield [("sell_item", {"description": description, "details": details,
+                                        "cost": int(cost), "category_id": int(category_id)})]
+        return result
+    if text.startswith("Что я купил"):
+        history, = yield [("get_user_purchase_history", {})]
+        return f"Последних покупок: {len(history['items'])}"
+    return "Меняла вас не понял"
+
+
+def trade_message(rng):
+    """Случайное сообщение игрока: просмотр, покупка, продажа или история."""
+    action = rng.choices(("categories", "browse", "buy", "sell", "history"), weights=(10, 30, 30, 20, 10))[0]
+    if action == "categories":
+        return "Какие категории есть?"
+    if action == "browse":
+        return f"Покажи категорию {rng.randint(1, 6)}"
+    if action == "buy":
+        return f"Куплю что-нибудь из категории {rng.randint(1, 6)}"
+    if action == "sell":
+        item = make_item_json(0, rng)
+        return (f"Продаю в категорию {rng.choice(SELLABLE_CATEGORIES)} за {item['cost']}. "
+                f"{item['description']}. {item['details']}")
+    return "Что я купил?"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+async def trade_session(chat_id, context, args, rng, latencies):
+    for _ in range(args.messages):
+        await asyncio.sleep(rng.expovariate(1 / args.think_time) if args.think_time else 0)
+        update = make_update(chat_id, trade_message(rng))
+        started = time.perf_counter()
+        await trader.handle_text_message(update, context)
+        latencies.append(time.perf_counter() - started)
+
+
+async def bench_trade(args):
+    """Сотни игроков покупают, продают и смотрят каталог через tool calls."""
+    rng = random.Random(args.seed)
+    trader.run_scheduler.max_concurrent = args.max_concurrent_runs
+    client = FakeOpenAI(args.latency, args.generation_time, trade_assistant, args.tool_call_time)
+    context = make_context(client)
+    chat_ids = create_players(args.players, balance=args.balance)
+    seed_catalog(chat_ids, args, rng)
+
+    bytes_before = trader.storage.bytes_written
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        trade_session(chat_id, context, args, random.Random(rng.random()), latencies) for chat_id in chat_ids
+    ))
+    await trader.run_scheduler.join()
+    await trader.send_queue.join()
+    elapsed = time.perf_counter() - started
+    written = trader.storage.bytes_written - bytes_before
+
+    report = {
+        "players": args.players,
+        "messages": len(latencies),
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "latency": {
+            "p50": round(percentile(latencies, 0.5), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+            "max": round(max(latencies, default=0.0), 4),
+        },
+        "storage_bytes": written,
+        "storage_bytes_per_message": round(written / max(len(latencies), 1), 1),
+        "runs": trader.run_metrics.runs,
+        "tools": {name: timing["calls"] for name, timing in sorted(trader.tool_timings.items())},
+        "tool_cache": {"hits": trader.tool_cache.hits, "misses": trader.tool_cache.misses},
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"Игроков: {report['players']}, сообщений: {report['messages']}, время: {elapsed:.2f} с")
+        print(f"Пропускная способность: {report['throughput']} сообщений/с")
+        print(f"Задержка ответа: p50 {report['latency']['p50']:.3f} с, p99 {report['latency']['p99']:.3f} с, "
+              f"макс {report['latency']['max']:.3f} с")
+        print(f"Запись в хранилище: {written / 1024:.1f} КБ ({report['storage_bytes_per_message']} байт на сообщение)")
+        print(f"Run: {report['runs']}, вызовы инструментов: {report['tools']}")
+    if trader.run_metrics.runs["failed"]:
+        sys.exit(f"ОШИБКА: {trader.run_metrics.runs['failed']} run завершились с ошибкой")
+    if args.max_p99 and report["latency"]["p99"] > args.max_p99:
+        sys.exit(f"ОШИБКА: p99 {report['latency']['p99']:.3f} с больше порога {args.max_p99} с")
+
+
+def add_trade_arguments(parser, players):
+    parser.add_argument("--players", type=int, default=players, help="Сколько игроков играют одновременно")
+    parser.add_argument("--messages", type=int, default=5, help="Сообщений от каждого игрока")
+    parser.add_argument("--think_time", type=float, default=0.2, help="Средняя пауза игрока между сообщениями, с")
+    parser.add_argument("--latency", type=float, default=0.005, help="Задержка одного вызова API, с")
+    parser.add_argument("--generation_time", type=float, default=0.05, help="Время генерации ответа, с")
+    parser.add_argument("--tool_call_time", type=float, default=0.02, help="Время до очередной пачки tool calls, с")
+    parser.add_argument("--max_concurrent_runs", type=int, default=trader.MAX_CONCURRENT_RUNS,
+                        help="Ограничение одновременных run (в каждом процессе)")
+    parser.add_argument("--catalog", type=int, default=500, help="Сколько записей в каталоге до начала")
+    parser.add_argument("--balance", type=int, default=10, help="Стартовый баланс игроков")
+    parser.add_argument("--seed", type=int, default=1, help="Зерно генератора сценария")
+
+
+def seed_catalog(chat_ids, args, rng):
+    for i in range(args.catalog):
+        item = make_item_json(0, rng)
+        trader.add_info(rng.choice(SELLABLE_CATEGORIES), rng.choice(chat_ids), f"Игрок {i}",
+                        item["description"], item["details"], item["cost"])
+
+
+async def bench_shard(args):
+    """Один процесс сценария workers: играют только игроки его шарда."""
+    worker_id = int(trader.WORKER_ID)
+    trader.run_scheduler.max_concurrent = args.max_concurrent_runs
+    client = FakeOpenAI(args.latency, args.generation_time, trade_assistant, args.tool_call_time)
+    context = make_context(client)
+    chat_ids = [chat_id for chat_id in create_players(args.players)
+                if trader.worker_for_chat(chat_id, args.workers) == worker_id]
+    catalog_before = sum(len(items) for items in trader.info.values())
+
+    sync_task = asyncio.create_task(trader.sync_storage_periodically())
+    latencies = []
+    started = time.time()
+    await asyncio.gather(*(
+        trade_session(chat_id, context, args, random.Random(args.seed * 1000003 + int(chat_id)), latencies)
+        for chat_id in chat_ids
+    ))
+    await trader.run_scheduler.join()
+    await trader.send_queue.join()
+    finished = time.time()
+    sync_task.cancel()
+
+    print(json.dumps({
+        "worker": worker_id,
+        "players": len(chat_ids),
+        "latencies": latencies,
+        "started": started,
+        "finished": finished,
+        "storage_bytes": trader.storage.bytes_written,
+        "failed_runs": trader.run_metrics.runs["failed"],
+        "catalog_seen": sum(len(items) for items in trader.info.values()) - catalog_before,
+    }))
+
+
+def bench_workers(args):
+    """Несколько процессов с общим SQLite-хранилищем: пропускная способность и целостность данных."""
+    rng = random.Random(args.seed)
+    chat_ids = create_players(args.players, balance=args.balance)
+    seed_catalog(chat_ids, args, rng)
+    trader.storage.close()
+    before_balances = {chat_id: trader.users[chat_id].balance for chat_id in chat_ids}
+    before_sizes = {category_id: len(items) for category_id, items in trader.info.items()}
+
+    argv = [sys.executable, os.path.abspath(__file__), "shard", "--workers", str(args.workers)]
+    for name in ("players", "messages", "think_time", "latency", "generation_time", "tool_call_time",
+                 "max_concurrent_runs", "catalog", "balance", "seed"):
+        argv += [f"--{name}", str(getattr(args, name))]
+    processes = [
+        subprocess.Popen(argv, stdout=subprocess.PIPE, env=dict(
+            os.environ,
+            SHIFTTRADER_BENCH_DIR=os.getcwd(),
+            SHIFTTRADER_STORE=trader.SHARED_STORE_FILE,
+            SHIFTTRADER_WORKER=str(worker_id),
+        ))
+        for worker_id in range(args.workers)
+    ]
+    reports = []
+    for process in processes:
+        output, _ = process.communicate()
+        if process.returncode:
+            sys.exit(f"ОШИБКА: процесс завершился с кодом {process.returncode}")
+        reports.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+
+    shared = trader.SqliteStorage(trader.SHARED_STORE_FILE)
+    shared.export()
+    shared.close()
+    with open(trader.INFO_FILE, encoding="utf-8") as f:
+        info = json.load(f)
+    with open(trader.USERS_FILE, encoding="utf-8") as f:
+        users = json.load(f)
+    history = {}
+    if os.path.exists(trader.PURCHASE_HISTORY_FILE):
+        with open(trader.PURCHASE_HISTORY_FILE, encoding="utf-8") as f:
+            history = json.load(f)
+
+    # Целостность: id в категориях без пропусков и повторов, балансы сходятся с продажами и покупками
+    errors = []
+    for category_id, items in info.items():
+        if [item["id"] for item in items] != list(range(1, len(items) + 1)):
+            errors.append(f"категория {category_id}: id записей не 1..{len(items)}")
+    expected = dict(before_balances)
+    for category_id, items in info.items():
+        for item in items[before_sizes[category_id]:]:
+            expected[item["seller_id"]] += item["cost"]
+    for chat_id, purchases in history.items():
+        expected[chat_id] -= sum(purchase["cost"] for purchase in purchases)
+    for chat_id in chat_ids:
+        if users[chat_id]["balance"] != expected[chat_id] or users[chat_id]["balance"] < 0:
+            errors.append(f"игрок {chat_id}: баланс {users[chat_id]['balance']}, ожидался {expected[chat_id]}")
+
+    latencies = [latency for report in reports for latency in report["latencies"]]
+    elapsed = max(r["finished"] for r in reports) - min(r["started"] for r in reports)
+    sold = sum(len(items) - before_sizes[category_id] for category_id, items in info.items())
+    print(f"Процессов: {args.workers}, игроков: {args.players}, сообщений: {len(latencies)}, время: {elapsed:.2f} с")
+    print(f"Пропускная способность: {len(latencies) / elapsed:.1f} сообщений/с")
+    print(f"Задержка ответа: p50 {percentile(latencies, 0.5):.3f} с, p99 {percentile(latencies, 0.99):.3f} с")
+    print(f"Запись в хранилище: {sum(r['storage_bytes'] for r in reports) / 1024:.1f} КБ")
+    print(f"Продано записей: {sold}, покупок: {sum(len(p) for p in history.values())}")
+    print("Новых записей каталога, увиденных процессами: "
+          + ", ".join(f"{r['worker']}: {r['catalog_seen']}" for r in sorted(reports, key=lambda r: r["worker"])))
+    failed = sum(r["failed_runs"] for r in reports)
+    if failed:
+        errors.append(f"{failed} run завершились с ошибкой")
+    if errors:
+        sys.exit("ОШИБКА: " + "; ".join(errors[:10]))
+    print("Целостность данных: OK")
+
+
+def assistant_reply(rng):
+    """Ответ ассистента: абзацы с **жирным**, изредка очень длинный."""
+    length = min(int(rng.lognormvariate(5.5, 1.2)), 20000)
+    paragraphs, size = [], 0
+    while size < length:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(5, 40))]
+        if rng.random() < 0.3:
+            words[0] = f"**{words[0]}**"
+        paragraphs.append(" ".join(words) + ("; цена < 5" if rng.random() < 0.1 else "."))
+        size += len(paragraphs[-1]) + 2
+    return "\n\n".join(paragraphs)
+
+
+def html_balanced(text):
+    stack = []
+    for match in trader.HTML_ATOM.finditer(text):
+        closing, name = match.group(1), match.group(2)
+        if name and not closing:
+            stack.append(name)
+        elif name and (not stack or stack.pop() != name):
+            return False
+    return not stack
+
+
+async def bench_send(args):
+    """Ответы ассистента уходят в Телеграм: лимиты, длинные тексты, склейка."""
+    rng = random.Random(args.seed)
+    bot = FakeBot(args.latency, limits=True, flood_probability=args.flood, rng=rng)
+    # Очередь на каждый воркер, как в режиме --workers: чаты разложены по worker_for_chat
+    queues = [trader.SendQueue() for _ in range(args.workers)]
+    if args.workers > 1:
+        for queue in queues:
+            queue.share_global_rate(args.workers)
+    expected = {}
+    failed = 0
+
+    async def chat(chat_id, chat_rng):
+        nonlocal failed
+        for _ in range(args.bursts):
+            await asyncio.sleep(chat_rng.expovariate(1 / args.think_time))
+            for _ in range(chat_rng.randint(1, args.burst)):
+                text = assistant_reply(chat_rng)
+                expected.setdefault(chat_id, []).append(text)
+                if not args.naive:
+                    queues[trader.worker_for_chat(chat_id, args.workers)].send(
+                        bot, chat_id, trader.format_assistant_text(text))
+                    continue
+                # Как было до очереди: каждое сообщение сразу, без нарезки и пауз
+                try:
+                    await bot.send_message(chat_id=chat_id, text=re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text),
+                                           parse_mode="HTML")
+                except TelegramError:
+                    failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(str(100000 + i), random.Random(rng.random())) for i in range(args.chats)))
+    await asyncio.gather(*(queue.join() for queue in queues))
+    stats = {key: sum(queue.metrics()[key] for queue in queues) for key in queues[0].metrics()}
+    elapsed = time.perf_counter() - started
+
+    def visible(texts):
+        return "".join("".join(texts).replace("**", "").split())
+
+    lost = sum(
+        visible(expected[chat_id]) != visible(trader.html.unescape(trader.HTML_TAG.sub("", part))
+                                              for part in bot.delivered.get(chat_id, []))
+        for chat_id in expected
+    )
+    unbalanced = sum(not html_balanced(part) for parts in bot.delivered.values() for part in parts)
+    messages = sum(len(texts) for texts in expected.values())
+    delivered = sum(len(parts) for parts in bot.delivered.values())
+    print(f"Чатов: {args.chats}, ответов: {messages}, режим: {'без очереди' if args.naive else 'очередь'}, "
+          f"время: {elapsed:.2f} с")
+    print(f"Вызовов send_message: {bot.calls}, доставлено сообщений: {delivered} ({delivered / elapsed:.1f}/с)")
+    print(f"RetryAfter: {bot.too_many}, слишком длинных: {bot.too_long}, не доставлено: "
+          f"{failed if args.naive else stats['failed']}")
+    if not args.naive:
+        print(f"Очередь: {stats}")
+    print(f"Чатов с потерянным или искажённым текстом: {lost}, частей с незакрытыми тегами: {unbalanced}")
+    if not args.naive and (lost or unbalanced or stats["failed"]):
+        sys.exit("ОШИБКА: не все ответы доставлены целиком")
+
+
+def make_item_json(item_id, rng):
+    details = " ".join(rng.choice(WORDS) for _ in range(60))
+    return {
+        "id": item_id,
+        "description": " ".join(rng.choice(WORDS) for _ in range(6)),
+        "details": details,
+        "cost": rng.randint(1, 3),
+        "cost_name": "штукарики",
+        "seller_id": str(100000 + rng.randrange(500)),
+        "seller_name": f"Игрок {rng.randrange(500)}"
+    }
+
+
+def measure(build):
+    """Сколько памяти удерживает результат build() (по tracemalloc)."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def bench_memory(args):
+    """Память под каталог: словари из JSON против записей trader.Item, плюс индексы каталога."""
+    rng = random.Random(1)
+    raw = json.dumps([make_item_json(i, rng) for i in range(1, args.items + 1)], ensure_ascii=False)
+
+    dicts, dict_size = measure(lambda: json.loads(raw))
+    del dicts
+    items, items_size = measure(lambda: [trader.Item.from_json(data) for data in json.loads(raw)])
+    del items
+
+    print(f"Записей: {args.items}")
+    print(f"dict:        {dict_size / 2**20:8.1f} МБ ({dict_size / args.items:.0f} байт на запись)")
+    print(f"trader.Item: {items_size / 2**20:8.1f} МБ ({items_size / args.items:.0f} байт на запись)")
+
+    # Индексы каталога: на тексте с большим словарём, как у живого каталога
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    items = [
+        trader.Item(i, make_text(vocabulary, weights, rng, 6), make_text(vocabulary, weights, rng), 1)
+        for i in range(1, args.items + 1)
+    ]
+    for index_class in (trader.SearchIndex, trader.DuplicateIndex):
+        def build():
+            index = index_class()
+            for item in items:
+                index.add(str(item.id % 5 + 2), item)
+            return index
+
+        _, index_size = measure(build)
+        print(f"{index_class.__name__ + ':':15} {index_size / 2**20:5.1f} МБ ({index_size / args.items:.0f} байт на запись)")
+
+
+SYLLABLES = "ма ги ко ра не ту ли ве до са ри ка мо ны зе ло пу та ви де".split()
+
+
+def make_vocabulary(size, rng):
+    """Словарь из выдуманных слов: у живого текста словарь намного больше WORDS."""
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(vocabulary)
+
+
+def make_text(vocabulary, weights, rng, length=60):
+    # Частоты слов — по закону Ципфа
+    return " ".join(rng.choices(vocabulary, cum_weights=weights, k=length))
+
+
+def paraphrase(details, rng, edits, vocabulary):
+    """Пересказ: несколько слов заменены, пара соседних переставлена."""
+    words = details.split()
+    for _ in range(edits):
+        words[rng.randrange(len(words))] = rng.choice(vocabulary)
+    i = rng.randrange(len(words) - 1)
+    words[i], words[i + 1] = words[i + 1], words[i]
+    return " ".join(words)
+
+
+def bench_duplicates(args):
+    """Проверка на дубли: стоимость поиска при росте каталога и доля пойманных пересказов."""
+    rng = random.Random(1)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    index = trader.DuplicateIndex()
+    checkpoints = sorted({min(args.items, n) for n in (1000, 10000, 100000, args.items)})
+    texts = []
+    added = 0
+    started = time.perf_counter()
+    for checkpoint in checkpoints:
+        while added < checkpoint:
+            added += 1
+            details = make_text(vocabulary, weights, rng)
+            texts.append(details)
+            index.add(str(rng.randint(2, 6)), trader.Item(added, "описание", details, 1))
+        build = time.perf_counter() - started
+
+        fresh, caught = [], 0
+        for _ in range(args.lookups):
+            text = make_text(vocabulary, weights, rng)
+            t = time.perf_counter()
+            index.most_similar(text)
+            fresh.append(time.perf_counter() - t)
+            found = index.most_similar(paraphrase(rng.choice(texts), rng, args.edits, vocabulary))
+            caught += bool(found and found[0] >= trader.DUPLICATE_REJECT_THRESHOLD)
+        fresh.sort()
+        print(f"Записей: {checkpoint:>7}, построение: {build:6.1f} с, проверка нового текста: "
+              f"p50 {fresh[len(fresh) // 2] * 1000:.3f} мс, p99 {fresh[int(len(fresh) * 0.99)] * 1000:.3f} мс, "
+              f"поймано пересказов: {caught / args.lookups:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки trader.py без сети")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    chats = commands.add_parser("chats", help="N чатов одновременно пишут боту")
+    chats.add_argument("--chats", type=int, default=50, help="Сколько чатов пишут одновременно")
+    chats.add_argument("--messages", type=int, default=3, help="Сообщений от каждого чата")
+    chats.add_argument("--latency", type=float, default=0.05, help="Задержка одного вызова API, с")
+    chats.add_argument("--generation_time", type=float, default=0.5, help="Время генерации ответа, с")
+    chats.add_argument("--max_concurrent_runs", type=int, default=trader.MAX_CONCURRENT_RUNS,
+                       help="Ограничение одновременных run")
+    chats.add_argument("--sequential", action="store_true", help="Обрабатывать чаты по одному (для сравнения)")
+
+    trade = commands.add_parser("trade", help="Игроки покупают, продают и смотрят каталог через tool calls")
+    add_trade_arguments(trade, players=300)
+    trade.add_argument("--json", action="store_true", help="Вывести отчёт в JSON (для CI)")
+    trade.add_argument("--max_p99", type=float, help="Завершиться с ошибкой, если p99 задержки больше, с")
+
+    memory = commands.add_parser("memory", help="Память под каталог: dict против записей, индексы")
+    memory.add_argument("--items", type=int, default=100000, help="Сколько записей в каталоге")
+    memory.add_argument("--vocabulary", type=int, default=20000, help="Размер словаря текстов для индексов")
+
+    workers = commands.add_parser("workers", help="Сценарий trade в нескольких процессах с общим хранилищем")
+    workers.add_argument("--workers", type=int, default=4, help="Сколько процессов")
+    add_trade_arguments(workers, players=400)
+
+    shard = commands.add_parser("shard", help="Один процесс сценария workers (запускается им самим)")
+    shard.add_argument("--workers", type=int, required=True)
+    add_trade_arguments(shard, players=400)
+
+    duplicates = commands.add_parser("duplicates", help="Поиск дублей при продаже на большом каталоге")
+    duplicates.add_argument("--items", type=int, default=100000, help="Сколько записей в каталоге")
+    duplicates.add_argument("--lookups", type=int, default=500, help="Сколько проверок на каждом размере каталога")
+    duplicates.add_argument("--edits", type=int, default=3, help="Сколько слов заменяется в пересказе")
+    duplicates.add_argument("--vocabulary", type=int, default=20000, help="Размер словаря синтетических текстов")
+
+
+    send = commands.add_parser("send", help="Доставка ответов в Телеграм с лимитами и длинными текстами")
+    send.add_argument("--chats", type=int, default=100, help="Сколько чатов получают ответы")
+    send.add_argument("--bursts", type=int, default=3, help="Сколько раз ассистент отвечает в каждый чат")
+    send.add_argument("--burst", type=int, default=3, help="До скольких сообщений в одном ответе")
+    send.add_argument("--think_time", type=float, default=1.0, help="Средняя пауза между ответами в чат, с")
+    send.add_argument("--latency", type=float, default=0.02, help="Задержка одного вызова send_message, с")
+    send.add_argument("--flood", type=float, default=0.0, help="Вероятность случайного RetryAfter")
+    send.add_argument("--workers", type=int, default=1, help="Сколько процессов-воркеров отправляют (по очереди на каждый)")
+    send.add_argument("--naive", action="store_true", help="Отправлять сразу и целиком, как до очереди (для сравнения)")
+    send.add_argument("--seed", type=int, default=1, help="Зерно генератора сценария")
+
+    args = parser.parse_args()
+    if args.command == "chats":
+        asyncio.run(bench_chats(args))
+    elif args.command == "trade":
+        asyncio.run(bench_trade(args))
+    elif args.command == "memory":
+        bench_memory(args)
+    elif args.command == "send":
+        asyncio.run(bench_send(args))
+    elif args.command == "workers":
+        bench_workers(args)
+    elif args.command == "shard":
+        asyncio.run(bench_shard(args))
+    elif args.command == "duplicates":
+        bench_duplicates(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+"""Общая подготовка тестов.
+
+trader.py при импорте читает данные и пишет логи в текущей директории, поэтому
+до первого импорта уводим её во временную — один раз на весь запуск.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="shifttrader_test_"))
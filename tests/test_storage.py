@@ -0,0 +1,87 @@
+"""Storage: журнал изменений переживает падение процесса и прерванное сворачивание."""
+import json
+import os
+import tempfile
+import unittest
+
+import trader
+
+JOURNAL = "test.journal"
+
+
+class StorageCrashTest(unittest.TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix="storage_"))
+        os.makedirs(trader.LOGS_DIR)
+        self.addCleanup(os.chdir, cwd)
+
+    def open_storage(self, **kwargs):
+        """Новый экземпляр — как после перезапуска процесса."""
+        storage = trader.Storage(JOURNAL, fsync=False, **kwargs)
+        self.addCleanup(self.close_journal, storage)
+        return storage
+
+    def close_journal(self, storage):
+        # Файл журнала закрываем без compact(): процесс «упал», снапшоты не записаны
+        if storage._journal is not None:
+            storage._journal.close()
+
+    def write_sales(self, storage):
+        storage.load(trader.USERS_FILE)
+        storage.load(trader.INFO_FILE)
+        storage.write([(trader.USERS_FILE, ["1"], {"name": "Аня", "balance": 0})])
+        storage.write([
+            (trader.INFO_FILE, ["2", 0], {"id": 1, "description": "запись"}),
+            (trader.USERS_FILE, ["1", "balance"], 3),
+        ])
+        storage.write([(trader.USERS_FILE, ["1", "balance"], 5)])
+
+    def assert_sales(self, storage):
+        self.assertEqual(storage.load(trader.USERS_FILE), {"1": {"name": "Аня", "balance": 5}})
+        self.assertEqual(storage.load(trader.INFO_FILE)["2"], [{"id": 1, "description": "запись"}])
+
+    def test_journal_is_replayed_after_unclean_exit(self):
+        self.write_sales(self.open_storage())
+        self.assertFalse(os.path.exists(trader.USERS_FILE))
+
+        self.assert_sales(self.open_storage())
+
+    def test_torn_last_line_is_dropped_and_truncated(self):
+        self.write_sales(self.open_storage())
+        good_size = os.path.getsize(JOURNAL)
+        with open(JOURNAL, "a", encoding="utf-8") as f:
+            f.write('[["users.json", ["1", "balance"], 10')
+
+        storage = self.open_storage()
+        self.assert_sales(storage)
+        self.assertEqual(os.path.getsize(JOURNAL), good_size)
+
+        # Следующая запись ложится отдельной целой строкой
+        storage.write([(trader.USERS_FILE, ["1", "balance"], 7)])
+        self.assertEqual(self.open_storage().load(trader.USERS_FILE)["1"]["balance"], 7)
+
+    def test_complete_last_line_without_newline_is_dropped(self):
+        self.write_sales(self.open_storage())
+        with open(JOURNAL, "a", encoding="utf-8") as f:
+            f.write('[["users.json", ["1", "balance"], 10]]')
+
+        self.assert_sales(self.open_storage())
+
+    def test_journal_replays_over_snapshot_of_interrupted_compaction(self):
+        storage = self.open_storage()
+        self.write_sales(storage)
+        # Сворачивание успело записать снапшоты, но не обнулило журнал
+        for file_path, data in storage.data.items():
+            storage._write_snapshot(file_path, data)
+        # ...а следующий снапшот оборвался до os.replace
+        with open(f"{trader.USERS_FILE}.tmp", "w", encoding="utf-8") as f:
+            f.write('{"1": {"name": "Ан')
+
+        restarted = self.open_storage()
+        self.assert_sales(restarted)
+
+        restarted.compact()
+        with open(trader.USERS_FILE, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), {"1": {"name": "Аня", "balance": 5}})
+        self.assertEqual(os.path.getsize(JOURNAL), 0)
@@ -0,0 +1,81 @@
+"""Логи игроков: ограниченное число открытых файлов, файлы по id игрока."""
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import trader
+
+USERS = 10000
+
+
+class CountingSinks(trader.UserLogSinks):
+    """UserLogSinks, запоминающий, сколько файлов было открыто одновременно."""
+
+    def __init__(self):
+        super().__init__()
+        self.max_open_seen = 0
+
+    def emit(self, record):
+        super().emit(record)
+        self.max_open_seen = max(self.max_open_seen, self.open_count())
+
+
+class UserLogSinksTest(unittest.TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix="user_logs_"))
+        os.makedirs(trader.LOGS_DIR)
+        self.addCleanup(os.chdir, cwd)
+        # Свой поток записи и логгер: записи можно дождаться, не останавливая общий log_writer
+        self.sinks = CountingSinks()
+        self.writer = trader.LogWriter()
+        self.addCleanup(self.writer.stop)
+        logger = logging.getLogger(f"users.{self.id()}")
+        logger.setLevel(logging.INFO)
+        self.writer.attach(logger, self.sinks)
+        patcher = mock.patch.object(trader, "users_logger", logger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read_log(self, user_id):
+        with open(os.path.join(trader.LOGS_DIR, f"user_{user_id}.log"), encoding="utf-8") as f:
+            return f.read()
+
+    def user_log_files(self):
+        return {name for name in os.listdir(trader.LOGS_DIR) if name.startswith("user_")}
+
+    def test_open_files_are_capped_for_many_users(self):
+        for i in range(USERS):
+            trader.get_user_logger(str(100000 + i)).info("Сообщение игрока %d", i)
+        self.writer.stop()
+
+        self.assertLessEqual(self.sinks.max_open_seen, trader.MAX_OPEN_USER_LOGS)
+        self.assertEqual(self.sinks.open_count(), 0)
+        self.assertEqual(self.user_log_files(), {f"user_{100000 + i}.log" for i in range(USERS)})
+        self.assertIn(f"Сообщение игрока {USERS - 1}", self.read_log(100000 + USERS - 1))
+
+    def test_evicted_file_is_reopened_for_append(self):
+        trader.get_user_logger("1").info("первая запись")
+        for i in range(trader.MAX_OPEN_USER_LOGS + 10):
+            trader.get_user_logger(str(1000 + i)).info("вытесняем")
+        trader.get_user_logger("1").info("вторая запись")
+        self.writer.stop()
+
+        lines = self.read_log(1).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("первая запись", lines[0])
+        self.assertIn("вторая запись", lines[1])
+
+    def test_rename_keeps_the_same_file(self):
+        trader.create_user("42", "Старое имя")
+        trader.get_user_logger("42").info("Игрок %s", trader.users["42"].name)
+        trader.create_user("42", "Новое имя")
+        trader.get_user_logger("42").info("Игрок %s", trader.users["42"].name)
+        self.writer.stop()
+
+        self.assertEqual(self.user_log_files(), {"user_42.log"})
+        log = self.read_log(42)
+        self.assertIn("Игрок Старое имя", log)
+        self.assertIn("Игрок Новое имя", log)
@@ -0,0 +1,92 @@
+"""Webhook-режим: локальный HTTP-клиент против serve_http + WebhookServer."""
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+
+import httpx
+
+import trader
+
+SECRET = "test-secret"
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 100500, "type": "private"},
+        "text": "Привет",
+    },
+}
+
+
+class WebhookTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        self.webhook = trader.WebhookServer(self.application, "/telegram", SECRET)
+        self.server = await trader.serve_http("127.0.0.1", 0, self.webhook.handle, self.webhook.check,
+                                              max_body=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.port}")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def raw_request(self, head, body=b""):
+        """Запрос «руками»: заголовки и тело, которые честный клиент не отправит."""
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), 5)
+        writer.close()
+        return int(status_line.split()[1])
+
+    async def test_valid_update_is_queued(self):
+        response = await self.client.post("/telegram", json=UPDATE,
+                                          headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+        self.assertEqual(response.status_code, 200)
+        update = self.application.update_queue.get_nowait()
+        self.assertEqual(update.update_id, 1)
+        self.assertEqual(update.message.text, "Привет")
+
+    async def test_bad_token_is_rejected(self):
+        response = await self.client.post("/telegram", json=UPDATE,
+                                          headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_bad_token_is_rejected_before_body(self):
+        # Тело огромное и не приходит: ответ всё равно сразу 401, а не ожидание тела
+        status = await self.raw_request(
+            "POST /telegram HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: wrong\r\n"
+            "Content-Length: 1000000000\r\n\r\n"
+        )
+        self.assertEqual(status, 401)
+
+    async def test_oversized_body_is_rejected(self):
+        status = await self.raw_request(
+            f"POST /telegram HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n"
+            "Content-Length: 1000000000\r\n\r\n"
+        )
+        self.assertEqual(status, 413)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_slow_body_times_out(self):
+        timeout = trader.HTTP_READ_TIMEOUT
+        trader.HTTP_READ_TIMEOUT = 0.1
+        try:
+            status = await self.raw_request(
+                f"POST /telegram HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n"
+                "Content-Length: 100\r\n\r\n", b"{"
+            )
+        finally:
+            trader.HTTP_READ_TIMEOUT = timeout
+        self.assertEqual(status, 408)
+
+    async def test_stopped_server_returns_503(self):
+        self.webhook.stop()
+        response = await self.client.post("/telegram", content=json.dumps(UPDATE),
+                                          headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+        self.assertEqual(response.status_code, 503)
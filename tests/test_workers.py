@@ -0,0 +1,214 @@
+"""Режим --workers: сокет воркера, перезапуск упавших воркеров, выгрузка общего хранилища."""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from telegram import Update
+
+import trader
+
+
+def make_update(update_id, chat_id=100500, text="Привет"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        },
+    }
+
+
+async def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("условие не выполнилось за отведённое время")
+        await asyncio.sleep(0.02)
+
+
+class StubApplication:
+    """То, что run_worker берёт у Application: жизненный цикл, bot и update_queue."""
+
+    post_init = post_stop = post_shutdown = None
+
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+        self.calls = []
+
+    async def initialize(self):
+        self.calls.append("initialize")
+
+    async def start(self):
+        self.calls.append("start")
+
+    async def stop(self):
+        self.calls.append("stop")
+
+    async def shutdown(self):
+        self.calls.append("shutdown")
+
+
+class RunWorkerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        workers_dir = trader.WORKERS_DIR
+        global_bucket = trader.send_queue.global_bucket
+        trader.WORKERS_DIR = tempfile.mkdtemp(prefix="workers_")
+        self.addCleanup(setattr, trader, "WORKERS_DIR", workers_dir)
+        self.addCleanup(setattr, trader.send_queue, "global_bucket", global_bucket)
+
+    async def test_updates_from_socket_reach_update_queue(self):
+        application = StubApplication()
+        socket_path = trader.worker_socket_path(0)
+        worker = asyncio.create_task(trader.run_worker(application, 0, 2))
+        await wait_for(lambda: os.path.exists(socket_path))
+
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        for update_id in (1, 2):
+            writer.write(json.dumps(make_update(update_id, text=f"сообщение {update_id}")).encode("utf-8") + b"\n")
+        await writer.drain()
+        received = [await asyncio.wait_for(application.update_queue.get(), 5) for _ in range(2)]
+        self.assertEqual([update.update_id for update in received], [1, 2])
+        self.assertEqual([update.message.text for update in received], ["сообщение 1", "сообщение 2"])
+
+        # Супервизор закрыл соединение — воркер дообрабатывает принятое и выходит
+        writer.close()
+        await asyncio.wait_for(worker, 5)
+        self.assertEqual(application.calls, ["initialize", "start", "stop", "shutdown"])
+        self.assertFalse(os.path.exists(socket_path))
+        # Лимит бота поделен между двумя воркерами
+        self.assertEqual(trader.send_queue.global_bucket.rate, trader.send_queue.rate / 2)
+
+
+# Воркер-заглушка: пишет «pid update_id» на каждый апдейт и выходит, когда супервизор закрыл сокет
+STUB_WORKER = r'''
+import asyncio, json, os, sys
+
+socket_path, received_path = sys.argv[1:3]
+
+
+async def main():
+    done = asyncio.Event()
+
+    async def on_supervisor(reader, writer):
+        while line := await reader.readline():
+            with open(received_path, "a") as f:
+                f.write(f"{os.getpid()} {json.loads(line)['update_id']}\n")
+        done.set()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    await asyncio.start_unix_server(on_supervisor, socket_path)
+    await done.wait()
+
+asyncio.run(main())
+'''
+
+
+class StubWorkerPool(trader.WorkerPool):
+    def __init__(self, count, received_path):
+        super().__init__(count, [])
+        self.received_path = received_path
+
+    def _spawn(self, worker_id):
+        self.processes[worker_id] = subprocess.Popen(
+            [sys.executable, "-c", STUB_WORKER, trader.worker_socket_path(worker_id), self.received_path]
+        )
+
+
+class WorkerPoolTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        workers_dir = trader.WORKERS_DIR
+        check_interval = trader.WORKER_CHECK_INTERVAL
+        trader.WORKERS_DIR = tempfile.mkdtemp(prefix="workers_")
+        self.addCleanup(setattr, trader, "WORKERS_DIR", workers_dir)
+        self.addCleanup(setattr, trader, "WORKER_CHECK_INTERVAL", check_interval)
+        self.received_path = os.path.join(trader.WORKERS_DIR, "received.log")
+
+    async def start_pool(self):
+        pool = StubWorkerPool(1, self.received_path)
+        pool.start()
+        self.addCleanup(self.kill_workers, pool)
+        await pool.connect()
+        return pool
+
+    def kill_workers(self, pool):
+        for process in pool.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    async def forward(self, pool, update_id):
+        await pool.forward(Update.de_json(make_update(update_id), None), None)
+
+    def received(self):
+        """update_id -> pid процесса, который его получил."""
+        if not os.path.exists(self.received_path):
+            return {}
+        with open(self.received_path) as f:
+            return {int(update_id): int(pid) for pid, update_id in (line.split() for line in f)}
+
+    async def kill(self, pool, worker_id=0):
+        process = pool.processes[worker_id]
+        process.kill()
+        await asyncio.to_thread(process.wait)
+        return process.pid
+
+    async def test_forward_restarts_dead_worker(self):
+        trader.WORKER_CHECK_INTERVAL = 3600  # перезапускает именно forward, а не проверка
+        pool = await self.start_pool()
+        await self.forward(pool, 1)
+        # Воркер должен успеть принять апдейт до того, как его убьют
+        await wait_for(lambda: 1 in self.received())
+        dead_pid = await self.kill(pool)
+
+        await self.forward(pool, 2)
+        restarted_pid = pool.processes[0].pid
+        await pool.stop()
+
+        self.assertEqual(pool.restarts, [1])
+        self.assertNotEqual(restarted_pid, dead_pid)
+        self.assertEqual(self.received(), {1: dead_pid, 2: restarted_pid})
+
+    async def test_watcher_restarts_dead_worker(self):
+        trader.WORKER_CHECK_INTERVAL = 0.05
+        pool = await self.start_pool()
+        dead_pid = await self.kill(pool)
+        await wait_for(lambda: pool.restarts == [1] and pool.writers[0] is not None)
+
+        await self.forward(pool, 1)
+        restarted_pid = pool.processes[0].pid
+        await pool.stop()
+
+        self.assertNotEqual(restarted_pid, dead_pid)
+        self.assertEqual(self.received(), {1: restarted_pid})
+
+
+class ExportSharedStoreTest(unittest.TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix="shared_store_"))
+        os.makedirs(trader.LOGS_DIR)
+        self.addCleanup(os.chdir, cwd)
+
+    def test_export_writes_json_and_removes_store(self):
+        with open(trader.USERS_FILE, "w", encoding="utf-8") as f:
+            json.dump({"1": {"name": "Аня", "balance": 5}}, f)
+        shared = trader.SqliteStorage(trader.SHARED_STORE_FILE)
+        shared.load(trader.USERS_FILE)
+        shared.write([(trader.USERS_FILE, ["1", "balance"], 7)])
+        shared.write([(trader.USERS_FILE, ["2"], {"name": "Боря", "balance": 3})])
+        shared.close()
+
+        trader.export_shared_store()
+
+        with open(trader.USERS_FILE, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), {"1": {"name": "Аня", "balance": 7}, "2": {"name": "Боря", "balance": 3}})
+        self.assertEqual([name for name in os.listdir() if name.startswith(trader.SHARED_STORE_FILE)], [])
@@ -1,11 +1,30 @@
 import json
+import math
 import os
 import logging
+import logging.handlers
+import atexit
+import queue
 import asyncio
 import argparse
+import array
+import bisect
+import contextlib
+import functools
+import heapq
+import hmac
+import html
 import re
-from datetime import datetime
+import secrets
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
 from pathlib import Path
+from urllib.parse import urlsplit
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
@@ -13,13 +32,17 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     filters,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 import random
+import zlib
 
 # Импортируйте ваш OpenAI SDK, как у вас настроено
+import httpx
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 # Файлы
 USERS_FILE = "users.json"
@@ -34,59 +57,866 @@ ASSISTANT_ID = "asst_VxE0V10Gi7Q3EXRIFvUSbqTp"
 # Состояния для ConversationHandler
 WAITING_FOR_NAME = 1
 
+# В режиме --workers супервизор передаёт воркерам путь к общему хранилищу и номер воркера
+SHARED_STORE = os.environ.get("SHIFTTRADER_STORE")
+WORKER_ID = os.environ.get("SHIFTTRADER_WORKER")
+
+
+def per_worker_path(path):
+    """У каждого воркера свои общие логи и дампы: писать в один файл из нескольких процессов ненадёжно."""
+    if WORKER_ID is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_worker{WORKER_ID}{ext}"
+
 # Создаем директорию для логов, если её нет
 if not os.path.exists(LOGS_DIR):
     os.makedirs(LOGS_DIR)
 
+# Ротация лог-файлов по размеру
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Сколько записей фоновый писатель обрабатывает перед сбросом на диск
+LOG_BATCH_SIZE = 500
+# Как подробно логировать тексты сообщений и результаты инструментов в run:
+# "full" — целиком, "short" — первые LOG_PAYLOAD_LIMIT символов, "none" — только размер
+LOG_PAYLOADS = "full"
+LOG_PAYLOAD_LIMIT = 300
+
+
+class BatchedFileHandler(logging.Handler):
+    """Файловый хендлер с ротацией по размеру, который не сбрасывает буфер на каждой строке."""
+
+    def __init__(self, path, formatter, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.setFormatter(formatter)
+        self.stream = None
+        self.size = 0
+
+    def _open(self):
+        self.stream = open(self.path, "a", encoding="utf-8")
+        self.size = self.stream.tell()
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + "\n"
+            if self.stream is None:
+                self._open()
+            length = len(line.encode("utf-8"))
+            if self.max_bytes and self.size and self.size + length > self.max_bytes:
+                self.rotate()
+            self.stream.write(line)
+            self.size += length
+        except Exception:
+            self.handleError(record)
+
+    def rotate(self):
+        self.stream.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.flush()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        super().close()
+
+
+class LogWriter:
+    """Фоновый поток, который пишет логи в файлы пачками.
+
+    Логгеры только кладут записи в очередь (QueueHandler), а поток раскладывает
+    их по файлам по имени логгера и сбрасывает буферы, когда очередь опустела
+    или набралось LOG_BATCH_SIZE записей. Event loop на диск не ходит.
+    """
+
+    def __init__(self, batch_size=LOG_BATCH_SIZE):
+        self.queue = queue.SimpleQueue()
+        self.batch_size = batch_size
+        self.routes = {}
+        self._routes_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def attach(self, logger, handler):
+        """Направляет записи логгера в handler через очередь."""
+        with self._routes_lock:
+            self.routes[logger.name] = handler
+        logger.addHandler(logging.handlers.QueueHandler(self.queue))
+        logger.propagate = False
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            touched = set()
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                with self._routes_lock:
+                    handler = self.routes.get(record.name)
+                if handler is not None:
+                    handler.handle(record)
+                    touched.add(handler)
+            for handler in touched:
+                handler.flush()
+        with self._routes_lock:
+            for handler in self.routes.values():
+                handler.close()
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.stop)
+
+
+class LogPayload:
+    """Аргумент записи лога: str() считается, только если запись действительно пишется."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = str(self.value)
+        if LOG_PAYLOADS == "full":
+            return text
+        if LOG_PAYLOADS == "short":
+            return text if len(text) <= LOG_PAYLOAD_LIMIT else f"{text[:LOG_PAYLOAD_LIMIT]}... ({len(text)} символов)"
+        return f"<{len(text)} символов>"
+
+
+def log_payload(value):
+    """Текст для логов в run_assistant с учётом LOG_PAYLOADS (вычисляется лениво)."""
+    return LogPayload(value)
+
+
 # Настраиваем общее логирование
 general_logger = logging.getLogger('general')
 general_logger.setLevel(logging.DEBUG)
-general_handler = logging.FileHandler(os.path.join(LOGS_DIR, 'general.log'), encoding='utf-8')
-general_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-general_logger.addHandler(general_handler)
+log_writer.attach(general_logger, BatchedFileHandler(
+    per_worker_path(os.path.join(LOGS_DIR, 'general.log')),
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+))
 
 # Логирование операций
 OPERATIONS_LOG = "operations.log"
+operations_logger = logging.getLogger('operations')
+operations_logger.setLevel(logging.INFO)
+log_writer.attach(operations_logger, BatchedFileHandler(
+    per_worker_path(OPERATIONS_LOG),
+    logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+))
+
+
 def log_operation(text):
-    with open(OPERATIONS_LOG, "a", encoding="utf-8") as f:
-        f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {text}\n")
+    operations_logger.info(text)
+
+# Сколько файлов пользовательских логов держим открытыми одновременно
+MAX_OPEN_USER_LOGS = 128
+
+
+class UserLogSinks(logging.Handler):
+    """Раскладывает записи логгера 'users' по файлам logs/user_<id>.log.
+
+    Открытыми держатся не больше max_open файлов: давно не писавшие игроки
+    вытесняются (LRU), а их файл снова открывается при следующей записи.
+    Работает в потоке LogWriter.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_USER_LOGS):
+        super().__init__()
+        self.max_open = max_open
+        self.formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        self._sinks = OrderedDict()
+        self._dirty = set()
+
+    def open_count(self):
+        return len(self._sinks)
+
+    def emit(self, record):
+        user_id = getattr(record, "user_id", "unknown")
+        sink = self._sinks.get(user_id)
+        if sink is None:
+            if len(self._sinks) >= self.max_open:
+                evicted_id, evicted = self._sinks.popitem(last=False)
+                self._dirty.discard(evicted_id)
+                evicted.close()
+            sink = self._sinks[user_id] = BatchedFileHandler(
+                os.path.join(LOGS_DIR, f'user_{user_id}.log'), self.formatter
+            )
+        else:
+            self._sinks.move_to_end(user_id)
+        sink.handle(record)
+        self._dirty.add(user_id)
+
+    def flush(self):
+        for user_id in self._dirty:
+            self._sinks[user_id].flush()
+        self._dirty.clear()
+
+    def close(self):
+        for sink in self._sinks.values():
+            sink.close()
+        self._sinks.clear()
+        self._dirty.clear()
+        super().close()
+
+
+users_logger = logging.getLogger('users')
+users_logger.setLevel(logging.INFO)
+user_log_sinks = UserLogSinks()
+log_writer.attach(users_logger, user_log_sinks)
+
 
 # Функция для получения логгера пользователя
-def get_user_logger(user_id: str, user_name: str) -> logging.Logger:
-    logger = logging.getLogger(f'user_{user_id}')
-    if not logger.handlers:
-        handler = logging.FileHandler(
-            os.path.join(LOGS_DIR, f'user_{user_id}_{user_name}.log'),
-            encoding='utf-8'
-        )
-        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-        logger.addHandler(handler)
-        logger.setLevel(logging.INFO)
-    return logger
+def get_user_logger(user_id: str) -> logging.LoggerAdapter:
+    return logging.LoggerAdapter(users_logger, {"user_id": user_id})
 
 # ------------------------------------------------------------------------------
 # Загрузка и сохранение данных
 # ------------------------------------------------------------------------------
-def load_data(file_path):
-    if not Path(file_path).exists():
-        # Создаём файл и инициализируем пустой структурой
-        if file_path == INFO_FILE:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump({"1": [], "2": [], "3": [], "4": [], "5": [], "6": []}, f, ensure_ascii=False, indent=4)
+# Журнал изменений: каждая строка — пачка операций "записать значение по пути"
+STORAGE_JOURNAL = "storage.journal"
+# После скольких записей в журнале пересобираем снапшоты и обнуляем журнал
+STORAGE_COMPACT_EVERY = 1000
+# fsync после каждой записи в журнал (данные переживут и падение питания)
+STORAGE_FSYNC = True
+
+
+def default_data(file_path):
+    """Структура, которой инициализируется отсутствующий файл."""
+    if file_path == INFO_FILE:
+        return {"1": [], "2": [], "3": [], "4": [], "5": [], "6": []}
+    return {}
+
+
+def apply_change(data, path, value):
+    """Записывает value по пути path внутри data и возвращает (возможно новый) корень.
+
+    Индекс, равный длине списка, означает добавление в конец. Операция
+    идемпотентна: повторное применение даёт тот же результат.
+    """
+    if not path:
+        return value
+    target = data
+    for key in path[:-1]:
+        target = target[key] if isinstance(target, (dict, list)) else getattr(target, key)
+    last = path[-1]
+    if isinstance(target, list) and last == len(target):
+        target.append(value)
+    elif isinstance(target, (dict, list)):
+        target[last] = value
+    else:
+        # Записи (User, Item, Purchase) меняются через атрибуты
+        setattr(target, last, value)
+    return data
+
+
+def to_json(value):
+    """json default: записи сериализуются в словари прежнего формата."""
+    return value.to_json()
+
+
+def write_json_atomic(file_path, data, fsync=STORAGE_FSYNC):
+    """Пишет JSON через временный файл и os.replace; возвращает размер файла."""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4, default=to_json)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+    return os.path.getsize(file_path)
+
+
+class Storage:
+    """JSON-снапшоты плюс общий append-only журнал изменений.
+
+    Снапшоты остаются обычными JSON-файлами прежнего формата. Изменения
+    дописываются в журнал одной строкой на пачку, поэтому цена записи не
+    зависит от объёма данных. Раз в STORAGE_COMPACT_EVERY записей снапшоты
+    перезаписываются атомарно (tmp + os.replace), а журнал обнуляется.
+    Оборванная последняя строка журнала при старте отбрасывается.
+    """
+
+    def __init__(self, journal_path, compact_every=STORAGE_COMPACT_EVERY, fsync=STORAGE_FSYNC):
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.data = {}
+        self.bytes_written = 0
+        self._pending = None
+        self._journal = None
+        self._journal_entries = 0
+        self._lock = threading.RLock()
+
+    def load(self, file_path):
+        if file_path in self.data:
+            return self.data[file_path]
+        if self._pending is None:
+            self._pending = self._read_journal()
+        data = self._read_snapshot(file_path)
+        for path, value in self._pending.pop(file_path, []):
+            data = apply_change(data, path, value)
+        self.data[file_path] = data
+        return data
+
+    def write(self, changes):
+        """Применяет пачку изменений [(file_path, path, value), ...] атомарно."""
+        with self._lock:
+            line = json.dumps([[f, list(p), v] for f, p, v in changes], ensure_ascii=False, default=to_json) + "\n"
+            journal = self._open_journal()
+            journal.write(line)
+            journal.flush()
+            if self.fsync:
+                os.fsync(journal.fileno())
+            for file_path, path, value in changes:
+                self.data[file_path] = apply_change(self.load(file_path), path, value)
+            self.bytes_written += len(line.encode("utf-8"))
+            self._journal_entries += 1
+            if self._journal_entries >= self.compact_every:
+                self.compact()
+
+    def attach(self, file_path, data):
+        """Подменяет данные файла в памяти (например, на записи), ничего не записывая."""
+        self.load(file_path)
+        self.data[file_path] = data
+
+    def subscribe(self, file_path, listener):
+        """Хранилище одного процесса: чужих изменений не бывает, подписка не нужна."""
+
+    def sync(self):
+        pass
+
+    async def sync_async(self):
+        pass
+
+    @contextlib.contextmanager
+    def transaction(self, patience=0):
+        # В одном процессе транзакции не пересекаются: обработчики выполняются в цикле событий
+        yield
+
+    def replace(self, file_path, data):
+        """Полностью заменяет содержимое файла (через снапшот)."""
+        self.load(file_path)
+        self.data[file_path] = data
+        self.compact()
+
+    def compact(self):
+        """Пишет снапшоты всех файлов и обнуляет журнал."""
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        if self._pending:
+            for file_path in list(self._pending):
+                self.load(file_path)
+        for file_path, data in self.data.items():
+            self._write_snapshot(file_path, data)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        self._journal_entries = 0
+
+    def close(self):
+        self.compact()
+
+    def _open_journal(self):
+        if self._journal is None:
+            if self._pending is None:
+                self._pending = self._read_journal()
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        return self._journal
+
+    def _read_snapshot(self, file_path):
+        if not Path(file_path).exists():
+            # Файл появится при первом сворачивании журнала
+            return default_data(file_path)
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_snapshot(self, file_path, data):
+        self.bytes_written += write_json_atomic(file_path, data, self.fsync)
+
+    def _read_journal(self):
+        pending = {}
+        if not Path(self.journal_path).exists():
+            return pending
+        good_size = 0
+        with open(self.journal_path, "rb") as f:
+            for raw in f:
+                try:
+                    changes = json.loads(raw.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    general_logger.warning(f"Журнал {self.journal_path} оборван после {good_size} байт, хвост отброшен")
+                    break
+                if not raw.endswith(b"\n"):
+                    break
+                for file_path, path, value in changes:
+                    pending.setdefault(file_path, []).append((path, value))
+                good_size += len(raw)
+                self._journal_entries += 1
+        if good_size != os.path.getsize(self.journal_path):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_size)
+        return pending
+
+
+# Общее хранилище процессов-воркеров
+SHARED_STORE_FILE = "shared_store.sqlite3"
+# Сколько SQLite сам ждёт блокировки на запись, с. Ожидание блокирует цикл событий,
+# поэтому оно короткое, а дальше запись повторяется через call_with_storage_retry
+SHARED_STORE_BUSY_TIMEOUT = 0.05
+# Сколько всего ждать, пока другой воркер держит базу на запись, с
+SHARED_STORE_WRITE_TIMEOUT = 10
+SHARED_STORE_RETRY_DELAY = 0.01
+SHARED_STORE_RETRY_MAX_DELAY = 0.2
+# Как часто воркер подтягивает чужие изменения, с
+SHARED_STORE_SYNC_INTERVAL = 1.0
+
+
+class StorageBusy(Exception):
+    """Общее хранилище занято записью другого воркера; ничего не записано, можно повторить."""
+
+
+async def call_with_storage_retry(func, *args, **kwargs):
+    """Вызывает синхронную func, которая пишет в хранилище.
+
+    Если база занята другим воркером, ждёт с нарастающей паузой, не блокируя
+    цикл событий, и повторяет — до SHARED_STORE_WRITE_TIMEOUT.
+    """
+    delay = SHARED_STORE_RETRY_DELAY
+    deadline = time.monotonic() + SHARED_STORE_WRITE_TIMEOUT
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except StorageBusy:
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SHARED_STORE_RETRY_MAX_DELAY)
+
+
+class SqliteStorage:
+    """Хранилище, общее для процессов-воркеров: SQLite в режиме WAL.
+
+    Интерфейс как у Storage. Таблица snapshots хранит содержимое JSON-файлов
+    (при первом обращении импортируется с диска), ops — пачки изменений в
+    порядке seq, как строки журнала. Каждый процесс держит данные в памяти и
+    догоняет чужие пачки в sync(). Внутри transaction() база заблокирована на
+    запись (BEGIN IMMEDIATE) и уже догнана, поэтому проверка баланса и выдача
+    id в каталоге видят самое свежее состояние.
+
+    Чужие изменения файла применяет подписчик (subscribe), если он есть: так
+    JSON превращается в записи, а индексы каталога и кэш ответов обновляются.
+    """
+
+    def __init__(self, db_path, fsync=STORAGE_FSYNC):
+        self.db_path = db_path
+        self.data = {}
+        self.bytes_written = 0
+        # seq последней применённой пачки (None — ещё ничего не загружено)
+        self.seq = None
+        self.listeners = {}
+        self._lock = threading.RLock()
+        self._in_transaction = False
+        self.db = sqlite3.connect(db_path, timeout=SHARED_STORE_BUSY_TIMEOUT,
+                                  isolation_level=None, check_same_thread=False)
+        # Отдельное соединение для чтения чужих пачек из потока (sync_async)
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (file TEXT PRIMARY KEY, data TEXT NOT NULL, seq INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS ops (seq INTEGER PRIMARY KEY AUTOINCREMENT, changes TEXT NOT NULL)")
+
+    @contextlib.contextmanager
+    def transaction(self, patience=0):
+        """Блокирует базу на запись и догоняет чужие пачки.
+
+        Если база занята дольше patience секунд (плюс SHARED_STORE_BUSY_TIMEOUT),
+        бросает StorageBusy. Ждать дольше без блокировки цикла позволяет
+        call_with_storage_retry.
+        """
+        with self._lock:
+            if self._in_transaction:
+                yield
+                return
+            self._begin(patience)
+            self._in_transaction = True
+            try:
+                self.sync()
+                yield
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            finally:
+                self._in_transaction = False
+
+    def _begin(self, patience):
+        deadline = time.monotonic() + patience
+        while True:
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if time.monotonic() >= deadline:
+                    raise StorageBusy(f"{self.db_path} занят другим процессом") from e
+                time.sleep(SHARED_STORE_RETRY_DELAY)
+
+    def load(self, file_path):
+        if file_path in self.data:
+            return self.data[file_path]
+        # Загрузка идёт при старте, до цикла событий, — здесь можно подождать
+        with self.transaction(patience=SHARED_STORE_WRITE_TIMEOUT):
+            head = self._head()
+            row = self.db.execute("SELECT data, seq FROM snapshots WHERE file = ?", (file_path,)).fetchone()
+            if row is None:
+                data = self._import(file_path, head)
+                snapshot_seq = head
+            else:
+                data = json.loads(row[0])
+                snapshot_seq = row[1]
+            for _, changes in self._ops_after(snapshot_seq):
+                for changed_file, path, value in changes:
+                    if changed_file == file_path:
+                        data = apply_change(data, path, value)
+            self.data[file_path] = data
+            self.seq = head
+            return data
+
+    def write(self, changes):
+        """Применяет пачку изменений [(file_path, path, value), ...] атомарно."""
+        with self.transaction():
+            for file_path, _, _ in changes:
+                self.load(file_path)
+            line = json.dumps([[f, list(p), v] for f, p, v in changes], ensure_ascii=False, default=to_json)
+            self.seq = self.db.execute("INSERT INTO ops (changes) VALUES (?)", (line,)).lastrowid
+            for file_path, path, value in changes:
+                self.data[file_path] = apply_change(self.data[file_path], path, value)
+            self.bytes_written += len(line.encode("utf-8"))
+
+    def sync(self):
+        """Применяет пачки, записанные другими процессами."""
+        with self._lock:
+            if self.seq is None:
+                return
+            self._apply(self._ops_after(self.seq))
+
+    async def sync_async(self):
+        """sync() для цикла событий: пачки читаются в потоке, применяются здесь."""
+        if self.seq is None:
+            return
+        ops = await asyncio.to_thread(self._read_ops_after, self.seq)
+        with self._lock:
+            self._apply(ops)
+
+    def _read_ops_after(self, seq):
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            return [(row_seq, json.loads(changes)) for row_seq, changes in
+                    self._reader.execute("SELECT seq, changes FROM ops WHERE seq > ? ORDER BY seq", (seq,))]
+
+    def _apply(self, ops):
+        for seq, changes in ops:
+            # Пока пачки читались, их могла применить транзакция
+            if seq <= self.seq:
+                continue
+            for file_path, path, value in changes:
+                if file_path not in self.data:
+                    continue
+                listener = self.listeners.get(file_path)
+                if listener is not None:
+                    listener(path, value)
+                else:
+                    self.data[file_path] = apply_change(self.data[file_path], path, value)
+            self.seq = seq
+
+    def attach(self, file_path, data):
+        self.load(file_path)
+        self.data[file_path] = data
+
+    def subscribe(self, file_path, listener):
+        """listener(path, value) применяет чужое изменение файла к данным в памяти."""
+        self.listeners[file_path] = listener
+
+    def replace(self, file_path, data):
+        self.write([(file_path, [], data)])
+
+    def compact(self):
+        """Снапшоты сворачивает супервизор (export), пока воркеры не работают."""
+
+    def close(self):
+        self.db.close()
+        if self._reader is not None:
+            self._reader.close()
+
+    def export(self):
+        """Сворачивает пачки в снапшоты и пишет их обратно в JSON-файлы."""
+        with self.transaction(patience=SHARED_STORE_WRITE_TIMEOUT):
+            head = self._head()
+            ops = self._ops_after(0)
+            for file_path, raw, snapshot_seq in self.db.execute("SELECT file, data, seq FROM snapshots").fetchall():
+                data = json.loads(raw)
+                for seq, changes in ops:
+                    if seq > snapshot_seq:
+                        for changed_file, path, value in changes:
+                            if changed_file == file_path:
+                                data = apply_change(data, path, value)
+                self.bytes_written += write_json_atomic(file_path, data)
+                self.db.execute("UPDATE snapshots SET data = ?, seq = ? WHERE file = ?",
+                                (json.dumps(data, ensure_ascii=False), head, file_path))
+            self.db.execute("DELETE FROM ops")
+
+    def _head(self):
+        return self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM ops").fetchone()[0]
+
+    def _ops_after(self, seq):
+        return [(row_seq, json.loads(changes)) for row_seq, changes in
+                self.db.execute("SELECT seq, changes FROM ops WHERE seq > ? ORDER BY seq", (seq,))]
+
+    def _import(self, file_path, head):
+        # Первое обращение к файлу: берём JSON-снапшот, который супервизор свернул перед стартом
+        if Path(file_path).exists():
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
         else:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump({}, f, ensure_ascii=False, indent=4)
-    with open(file_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+            data = default_data(file_path)
+        self.db.execute("INSERT INTO snapshots (file, data, seq) VALUES (?, ?, ?)",
+                        (file_path, json.dumps(data, ensure_ascii=False), head))
+        return data
+
+
+storage = SqliteStorage(SHARED_STORE) if SHARED_STORE else Storage(STORAGE_JOURNAL)
+
+
+def load_data(file_path):
+    return storage.load(file_path)
 
 
 def save_data(file_path, data):
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    storage.replace(file_path, data)
+
+
+def save_change(file_path, path, value, tx=None):
+    """Записывает одно изменение в журнал (без перезаписи всего файла).
+
+    Если передана транзакция, изменение лишь добавляется в неё.
+    """
+    if tx is not None:
+        tx.set(file_path, path, value)
+    else:
+        storage.write([(file_path, path, value)])
+
+
+# ------------------------------------------------------------------------------
+# Транзакции
+# ------------------------------------------------------------------------------
+class Transaction:
+    """Изменения баланса, каталога и истории, которые применяются целиком или никак.
+
+    Обработчики выполняются в цикле событий, и внутри with нет await, поэтому
+    в одном процессе транзакцию ничто не прерывает и блокировки не нужны.
+    Процессы-воркеры исключает storage.transaction(): с общим хранилищем база
+    на время транзакции заблокирована на запись и догнана до свежего состояния.
+    Изменения копятся до выхода из with и уходят в журнал одной строкой; при
+    исключении внутри with ничего не записывается.
+    """
+
+    def __init__(self):
+        self.changes = []
+        self.on_commit = []
+
+    def set(self, file_path, path, value):
+        self.changes.append((file_path, path, value))
+
+    def __enter__(self):
+        self._storage_transaction = storage.transaction()
+        self._storage_transaction.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None and self.changes:
+                storage.write(self.changes)
+                for callback in self.on_commit:
+                    callback()
+        except BaseException:
+            self._storage_transaction.__exit__(*sys.exc_info())
+            raise
+        self._storage_transaction.__exit__(exc_type, exc, tb)
+        return False
+
+
+# ------------------------------------------------------------------------------
+# Записи: игроки, информация, покупки
+# ------------------------------------------------------------------------------
+DEFAULT_COST_NAME = "штукарики"
+
+
+def pack_text(text):
+    return zlib.compress(text.encode("utf-8"))
+
+
+def unpack_text(data):
+    return zlib.decompress(data).decode("utf-8")
+
+
+class User:
+    __slots__ = ("name", "balance", "thread_id")
 
+    def __init__(self, name, balance=0, thread_id=None):
+        self.name = name
+        self.balance = balance
+        self.thread_id = thread_id
 
-users = load_data(USERS_FILE)
-info = load_data(INFO_FILE)
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["name"], data.get("balance", 0), data.get("thread_id"))
+
+    def to_json(self):
+        return {"name": self.name, "balance": self.balance, "thread_id": self.thread_id}
+
+
+class Item:
+    """Запись каталога.
+
+    details хранится сжатым и распаковывается только при обращении — полный
+    текст нужен лишь при покупке. Названия валют и имена продавцов интернируются.
+    """
+    __slots__ = ("id", "description", "_details", "cost", "cost_name", "seller_id", "seller_name")
+
+    def __init__(self, id, description, details, cost, cost_name=DEFAULT_COST_NAME, seller_id=None, seller_name=None):
+        self.id = id
+        self.description = description
+        self._details = pack_text(details)
+        self.cost = cost
+        self.cost_name = sys.intern(cost_name)
+        self.seller_id = seller_id
+        self.seller_name = sys.intern(seller_name) if seller_name is not None else None
+
+    @property
+    def details(self):
+        return unpack_text(self._details)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["id"],
+            data.get("description", "<без описания>"),
+            data.get("details", ""),
+            data.get("cost", 0),
+            data.get("cost_name", DEFAULT_COST_NAME),
+            data.get("seller_id"),
+            data.get("seller_name")
+        )
+
+    def to_json(self):
+        data = {
+            "id": self.id,
+            "description": self.description,
+            "details": self.details,
+            "cost": self.cost,
+            "cost_name": self.cost_name
+        }
+        # У записей особого поставщика продавца нет
+        if self.seller_id is not None:
+            data["seller_id"] = self.seller_id
+            data["seller_name"] = self.seller_name
+        return data
+
+
+class Purchase:
+    """Запись истории покупок; сжатый details разделяется с записью каталога."""
+    __slots__ = ("category_id", "id", "description", "_details", "cost", "cost_name")
+
+    def __init__(self, category_id, id, description, packed_details, cost, cost_name=DEFAULT_COST_NAME):
+        self.category_id = category_id
+        self.id = id
+        self.description = description
+        self._details = packed_details
+        self.cost = cost
+        self.cost_name = sys.intern(cost_name)
+
+    @property
+    def details(self):
+        return unpack_text(self._details)
+
+    @classmethod
+    def from_item(cls, category_id, item):
+        return cls(category_id, item.id, item.description, item._details, item.cost, item.cost_name)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["category_id"],
+            data["id"],
+            data["description"],
+            pack_text(data["details"]),
+            data["cost"],
+            data.get("cost_name", DEFAULT_COST_NAME)
+        )
+
+    def to_json(self):
+        return {
+            "category_id": self.category_id,
+            "id": self.id,
+            "description": self.description,
+            "details": self.details,
+            "cost": self.cost,
+            "cost_name": self.cost_name
+        }
+
+
+users = {user_id: User.from_json(data) for user_id, data in load_data(USERS_FILE).items()}
+storage.attach(USERS_FILE, users)
+info = {
+    category_id: [Item.from_json(data) for data in items]
+    for category_id, items in load_data(INFO_FILE).items()
+}
+storage.attach(INFO_FILE, info)
+
+
+def apply_remote_user_change(path, value):
+    """Изменение users.json, сделанное другим воркером."""
+    if len(path) == 1:
+        users[path[0]] = User.from_json(value)
+    else:
+        apply_change(users, path, value)
+
+
+storage.subscribe(USERS_FILE, apply_remote_user_change)
 
 
 # ------------------------------------------------------------------------------
@@ -97,18 +927,12 @@ def get_user(user_id: str):
 
 
 def create_user(user_id: str, name: str):
-    users[user_id] = {
-        "name": name,
-        "balance": 0,
-        "thread_id": None
-    }
-    save_data(USERS_FILE, users)
+    save_change(USERS_FILE, [user_id], User(name))
     return users[user_id]
 
 
-def update_balance(user_id: str, amount: int):
-    users[user_id]["balance"] += amount
-    save_data(USERS_FILE, users)
+def update_balance(user_id: str, amount: int, tx=None):
+    save_change(USERS_FILE, [user_id, "balance"], users[user_id].balance + amount, tx)
 
 
 # Новая структура info: категории -> массивы инфы
@@ -128,81 +952,605 @@ def get_categories_with_counts():
         for cat_id in info.keys()
     ]
 
-def add_info(category_id, user_id, user_name, description, details, cost, cost_name="штукарики"):
+# ------------------------------------------------------------------------------
+# Полнотекстовый поиск по каталогу
+# ------------------------------------------------------------------------------
+# Параметры BM25
+SEARCH_K1 = 1.2
+SEARCH_B = 0.75
+# Слова описания весят больше слов подробностей
+SEARCH_DESCRIPTION_WEIGHT = 2
+SEARCH_DEFAULT_LIMIT = 5
+SEARCH_MAX_LIMIT = 20
+SEARCH_STOP_WORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот "
+    "от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь "
+    "опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была "
+    "сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним "
+    "здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об "
+    "другой хоть после над больше тот через эти нас про всего них какая много разве три эту моя впрочем "
+    "хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между".split()
+)
+RU_TOKEN = re.compile(r"[а-яёa-z0-9]+")
+RU_VOWEL = re.compile(r"[аеиоуыэюя]")
+RU_PERFECTIVE_GERUND = re.compile(r"(?:(?<=[ая])(?:в|вши|вшись)|(?:ив|ивши|ившись|ыв|ывши|ывшись))$")
+RU_REFLEXIVE = re.compile(r"(?:с[яь])$")
+RU_ADJECTIVE = re.compile(r"(?:ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$")
+RU_PARTICIPLE = re.compile(r"(?:(?<=[ая])(?:ем|нн|вш|ющ|щ)|(?:ивш|ывш|ующ))$")
+RU_VERB = re.compile(r"(?:(?<=[ая])(?:ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)"
+                     r"|(?:ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю))$")
+RU_NOUN = re.compile(r"(?:а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$")
+RU_DERIVATIONAL = re.compile(r"[^аеиоуыэюя][аеиоуыэюя]+[^аеиоуыэюя]+[аеиоуыэюя].*(?<=о)сть?$")
+RU_SUPERLATIVE = re.compile(r"(?:ейше|ейш)$")
+
+
+@functools.lru_cache(maxsize=100000)
+def stem_ru(word):
+    """Стемминг русского слова по алгоритму Портера (Snowball)."""
+    match = RU_VOWEL.search(word)
+    if not match:
+        return word
+    prefix, rv = word[:match.end()], word[match.end():]
+    stripped = RU_PERFECTIVE_GERUND.sub("", rv, 1)
+    if stripped == rv:
+        rv = RU_REFLEXIVE.sub("", rv, 1)
+        stripped = RU_ADJECTIVE.sub("", rv, 1)
+        if stripped != rv:
+            rv = RU_PARTICIPLE.sub("", stripped, 1)
+        else:
+            stripped = RU_VERB.sub("", rv, 1)
+            rv = RU_NOUN.sub("", rv, 1) if stripped == rv else stripped
+    else:
+        rv = stripped
+    rv = re.sub("и$", "", rv)
+    if RU_DERIVATIONAL.search(rv):
+        rv = re.sub("ость?$", "", rv)
+    stripped = re.sub("ь$", "", rv)
+    if stripped == rv:
+        rv = re.sub("нн$", "н", RU_SUPERLATIVE.sub("", rv, 1))
+    else:
+        rv = stripped
+    return prefix + rv
+
+
+def tokenize(text):
+    """Слова текста в нижнем регистре, без стоп-слов, приведённые к основе."""
+    return [
+        stem_ru(word) for word in RU_TOKEN.findall(text.lower().replace("ё", "е"))
+        if word not in SEARCH_STOP_WORDS
+    ]
+
+
+class SearchIndex:
+    """Инвертированный индекс по description и details с ранжированием BM25.
+
+    Документ — запись каталога; индекс пополняется из Catalog (см. Catalog.catch_up),
+    поэтому покрывает и загруженный каталог, и всё, что продано после старта.
+    Списки вхождений хранятся в array парами (номер документа, частота): на пару
+    уходит 8 байт, а не элемент словаря с двумя int-объектами.
+    """
+
+    def __init__(self):
+        # основа слова -> array("I") [документ, частота, документ, частота, ...] по возрастанию документа
+        self.postings = {}
+        # номер документа -> категория и запись
+        self.categories = []
+        self.items = []
+        self.doc_lengths = array.array("I")
+        self.total_length = 0
+
+    def add(self, category_id, item, description_terms=None, details_terms=None):
+        """Добавляет запись; уже разобранные на основы тексты можно передать готовыми."""
+        if description_terms is None:
+            description_terms = tokenize(item.description)
+        if details_terms is None:
+            details_terms = tokenize(item.details)
+        terms = description_terms * SEARCH_DESCRIPTION_WEIGHT + details_terms
+        frequencies = {}
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+        doc = len(self.items)
+        self.categories.append(category_id)
+        self.items.append(item)
+        self.doc_lengths.append(len(terms))
+        self.total_length += len(terms)
+        for term, count in frequencies.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array("I")
+            postings.append(doc)
+            postings.append(count)
+
+    def search(self, query, category_id=None, limit=SEARCH_DEFAULT_LIMIT):
+        """Лучшие limit записей по запросу: список (оценка, категория, запись)."""
+        terms = set(tokenize(query))
+        scores = {}
+        if not self.items:
+            return []
+        average_length = self.total_length / len(self.items)
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            found = len(postings) // 2
+            idf = math.log(1 + (len(self.items) - found + 0.5) / (found + 0.5))
+            for doc, frequency in zip(postings[::2], postings[1::2]):
+                norm = SEARCH_K1 * (1 - SEARCH_B + SEARCH_B * self.doc_lengths[doc] / average_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * frequency * (SEARCH_K1 + 1) / (frequency + norm)
+        if category_id is not None:
+            category_id = str(category_id)
+            scores = {doc: score for doc, score in scores.items() if self.categories[doc] == category_id}
+        best = heapq.nlargest(limit, scores.items(), key=lambda kv: kv[1])
+        return [(score, self.categories[doc], self.items[doc]) for doc, score in best]
+
+
+search_index = SearchIndex()
+
+
+# ------------------------------------------------------------------------------
+# Поиск почти одинаковых записей (MinHash + LSH)
+# ------------------------------------------------------------------------------
+# Сигнатура из DUPLICATE_BANDS полос по DUPLICATE_ROWS хэшей: кандидатами
+# становятся тексты с похожестью примерно от (1/BANDS) ** (1/ROWS) ≈ 0.6
+DUPLICATE_BANDS = 8
+DUPLICATE_ROWS = 4
+# Шинглы — пары подряд идущих основ слов
+DUPLICATE_SHINGLE = 2
+# Похожесть (оценка Жаккара), начиная с которой продажа отклоняется
+DUPLICATE_REJECT_THRESHOLD = 0.7
+# ...и начиная с которой продажа проходит, но попадает в лог операций
+DUPLICATE_FLAG_THRESHOLD = 0.5
+DUPLICATE_BINS = DUPLICATE_BANDS * DUPLICATE_ROWS
+
+
+class DuplicateIndex:
+    """MinHash/LSH-индекс по details записей каталога для поиска пересказов.
+
+    Сигнатура считается one-permutation hashing: каждый шингл хэшируется один
+    раз и попадает в одну из DUPLICATE_BINS корзин, где остаётся минимум;
+    пустые корзины заполняются из соседних справа (densification).
+
+    Как и SearchIndex, пополняется из Catalog. На запись хранится сигнатура
+    (DUPLICATE_BINS чисел в общем array) и по ключу на полосу, поэтому проверка
+    не зависит от размера каталога: сравниваются только записи, совпавшие с
+    текстом хотя бы в одной полосе.
+    """
+
+    def __init__(self):
+        # полоса -> {ключ полосы: номер документа или список номеров}
+        self._bands = [{} for _ in range(DUPLICATE_BANDS)]
+        # номер документа -> категория и запись
+        self.categories = []
+        self.items = []
+        # сигнатура документа doc — signatures[doc * DUPLICATE_BINS:(doc + 1) * DUPLICATE_BINS]
+        self.signatures = array.array("I")
+
+    def signature(self, text=None, words=None):
+        """Сигнатура текста (или уже готового списка основ words)."""
+        if words is None:
+            words = tokenize(text)
+        bins = [None] * DUPLICATE_BINS
+        for i in range(max(len(words) - DUPLICATE_SHINGLE + 1, 1)):
+            # crc32 перемешиваем умножением, чтобы младшие биты (номер корзины) были равномерны
+            value = zlib.crc32(" ".join(words[i:i + DUPLICATE_SHINGLE]).encode("utf-8")) * 0x9E3779B1 & 0xFFFFFFFF
+            slot = value % DUPLICATE_BINS
+            if bins[slot] is None or value < bins[slot]:
+                bins[slot] = value
+        signature = array.array("I", bytes(4 * DUPLICATE_BINS))
+        for slot in range(DUPLICATE_BINS):
+            for shift in range(DUPLICATE_BINS):
+                value = bins[(slot + shift) % DUPLICATE_BINS]
+                if value is not None:
+                    signature[slot] = (value + shift * 0x61C88647) & 0xFFFFFFFF
+                    break
+        return signature
+
+    def _band_keys(self, signature):
+        return [hash(tuple(signature[i:i + DUPLICATE_ROWS])) for i in range(0, len(signature), DUPLICATE_ROWS)]
+
+    def add(self, category_id, item, description_terms=None, details_terms=None):
+        """Добавляет запись; details, уже разобранный на основы, можно передать готовым."""
+        signature = self.signature(item.details, details_terms)
+        doc = len(self.items)
+        self.categories.append(category_id)
+        self.items.append(item)
+        self.signatures.extend(signature)
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            found = band.get(key)
+            if found is None:
+                band[key] = doc
+            elif isinstance(found, list):
+                found.append(doc)
+            else:
+                band[key] = [found, doc]
+
+    def most_similar(self, text):
+        """Самая похожая запись: (оценка похожести, категория, запись) или None."""
+        signature = self.signature(text)
+        candidates = set()
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            found = band.get(key)
+            if isinstance(found, list):
+                candidates.update(found)
+            elif found is not None:
+                candidates.add(found)
+        best = None
+        for doc in candidates:
+            stored = self.signatures[doc * DUPLICATE_BINS:(doc + 1) * DUPLICATE_BINS]
+            similarity = sum(x == y for x, y in zip(signature, stored)) / len(signature)
+            if best is None or similarity > best[0]:
+                best = (similarity, self.categories[doc], self.items[doc])
+        return best
+
+
+duplicate_index = DuplicateIndex()
+
+
+# Сколько записей за раз добавлять в полнотекстовый индекс и индекс дублей;
+# между пачками catch_up отдаёт цикл событий
+CATALOG_INDEX_BATCH = 100
+
+
+class Catalog:
+    """Индексы поверх info: id -> запись, следующий id и записи по продавцу.
+
+    Сам info остаётся словарём "категория -> список" в формате info.json.
+    Простые индексы обновляются сразу, а дорогие (полнотекстовый и индекс
+    дублей) — через очередь: при старте весь каталог разбирается в фоне
+    (catch_up), а не при импорте. Перед поиском и проверкой на дубль очередь
+    дочитывается — index_pending() или await catch_up().
+    """
+
+    def __init__(self, info, indexes=()):
+        self.info = info
+        # Дополнительные индексы с методом add(category_id, item, description_terms, details_terms)
+        self.indexes = indexes
+        # Растёт при каждом изменении каталога (для кэша ответов инструментов)
+        self.version = 0
+        # категория -> {id: запись}
+        self._by_id = {}
+        # категория -> следующий свободный id
+        self._next_id = {}
+        # seller_id -> [(категория, запись)]
+        self._by_seller = {}
+        # (категория, запись), ещё не добавленные в indexes
+        self._unindexed = deque()
+        for category_id, items in info.items():
+            self._by_id[category_id] = {}
+            self._next_id[category_id] = 1
+            for item in items:
+                self._index(category_id, item)
+
+    def _index(self, category_id, item):
+        self._by_id[category_id][item.id] = item
+        self._next_id[category_id] = max(self._next_id[category_id], item.id + 1)
+        self._by_seller.setdefault(item.seller_id, []).append((category_id, item))
+        self._unindexed.append((category_id, item))
+        self.version += 1
+
+    def index_pending(self, limit=None):
+        """Добавляет в indexes до limit записей из очереди (без limit — все)."""
+        count = len(self._unindexed) if limit is None else min(limit, len(self._unindexed))
+        for _ in range(count):
+            category_id, item = self._unindexed.popleft()
+            # Тексты разбираются на основы один раз для всех индексов
+            description_terms = tokenize(item.description)
+            details_terms = tokenize(item.details)
+            for index in self.indexes:
+                index.add(category_id, item, description_terms, details_terms)
+
+    async def catch_up(self):
+        """index_pending() пачками по CATALOG_INDEX_BATCH, не занимая цикл событий надолго."""
+        while self._unindexed:
+            self.index_pending(CATALOG_INDEX_BATCH)
+            await asyncio.sleep(0)
+
+    def get(self, category_id, item_id):
+        return self._by_id.get(str(category_id), {}).get(item_id)
+
+    def next_id(self, category_id):
+        return self._next_id[str(category_id)]
+
+    def by_seller(self, seller_id):
+        return self._by_seller.get(seller_id, [])
+
+    def apply_remote(self, path, value):
+        """Запись, добавленная в каталог другим воркером."""
+        category_id, position = path
+        if position < len(self.info[category_id]):
+            return
+        item = Item.from_json(value)
+        self.info[category_id].append(item)
+        self._index(category_id, item)
+
+    def add(self, category_id, item, tx=None):
+        category_id = str(category_id)
+        save_change(INFO_FILE, [category_id, len(self.info[category_id])], item, tx)
+        if tx is not None:
+            tx.on_commit.append(lambda: self._index(category_id, item))
+        else:
+            self._index(category_id, item)
+
+
+catalog = Catalog(info, (search_index, duplicate_index))
+storage.subscribe(INFO_FILE, catalog.apply_remote)
+
+
+# Сколько ответов инструментов держит кэш: ключи search_items — свободный текст,
+# поэтому между продажами их может набраться сколько угодно
+TOOL_CACHE_MAX_ENTRIES = 1000
+
+
+class ToolResultCache:
+    """Готовые JSON-ответы read-only инструментов, действительные до изменения каталога.
+
+    Хранит не больше max_entries ответов: давно не запрошенные вытесняются (LRU).
+    """
+
+    def __init__(self, catalog, max_entries=TOOL_CACHE_MAX_ENTRIES):
+        self.catalog = catalog
+        self.max_entries = max_entries
+        self._version = catalog.version
+        self._outputs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        if self._version != self.catalog.version:
+            self._outputs.clear()
+            self._version = self.catalog.version
+        output = self._outputs.get(key)
+        if output is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._outputs.move_to_end(key)
+        return output
+
+    def store(self, key, output):
+        if self._version == self.catalog.version:
+            self._outputs[key] = output
+            self._outputs.move_to_end(key)
+            if len(self._outputs) > self.max_entries:
+                self._outputs.popitem(last=False)
+
+
+tool_cache = ToolResultCache(catalog)
+
+
+def add_info(category_id, user_id, user_name, description, details, cost, cost_name="штукарики", tx=None):
     if category_id == 0:
         raise Exception("В категорию 0 нельзя продавать информацию! Особый поставщик только продает.")
     # id внутри категории
-    new_id = 1
-    if info[str(category_id)]:
-        new_id = max(item["id"] for item in info[str(category_id)]) + 1
-    info[str(category_id)].append({
-        "id": new_id,
-        "description": description,
-        "details": details,
-        "cost": cost,
-        "cost_name": cost_name,
-        "seller_id": user_id,
-        "seller_name": user_name
-    })
-    save_data(INFO_FILE, info)
+    new_id = catalog.next_id(category_id)
+    catalog.add(category_id, Item(new_id, description, details, cost, cost_name, user_id, user_name), tx)
     return new_id
 
 
-def handle_show_items(category_id):
-    if str(category_id) not in info:
+# Ответ инструмента (JSON) не длиннее стольких байт
+TOOL_OUTPUT_BUDGET = 6000
+# Длинные текстовые поля записей обрезаются до стольких символов
+TOOL_FIELD_LIMIT = 300
+# Сколько записей на странице по умолчанию и максимум
+TOOL_PAGE_SIZE = 20
+TOOL_MAX_PAGE_SIZE = 50
+# Сколько символов details отдаёт get_item_details за раз
+TOOL_DETAILS_CHUNK = 2000
+
+
+class Page:
+    """Страница ответа инструмента.
+
+    cursors[i] — курсор, с которого выдача продолжится начиная с records[i];
+    next_cursor — курсор после последней записи (None, если записей больше нет).
+    Если страница не влезает в TOOL_OUTPUT_BUDGET, render_tool_output отрезает
+    хвост и отдаёт курсор первой отрезанной записи.
+    """
+    __slots__ = ("records", "cursors", "next_cursor")
+
+    def __init__(self, records, cursors, next_cursor=None):
+        self.records = records
+        self.cursors = cursors
+        self.next_cursor = next_cursor
+
+
+def page_size(limit):
+    return max(1, min(limit, TOOL_MAX_PAGE_SIZE))
+
+
+def clip_field(record, field, text, category_id, item_id):
+    """Кладёт text в record[field], обрезая до TOOL_FIELD_LIMIT.
+
+    У обрезанного поля появляется field_more — аргументы get_item_details
+    для дочитывания.
+    """
+    if len(text) <= TOOL_FIELD_LIMIT:
+        record[field] = text
+        return record
+    record[field] = text[:TOOL_FIELD_LIMIT] + "…"
+    record[f"{field}_more"] = {
+        "tool": "get_item_details",
+        "category_id": int(category_id),
+        "item_id": item_id,
+        "offset": TOOL_FIELD_LIMIT
+    }
+    return record
+
+
+def render_tool_output(result):
+    """JSON-ответ инструмента в пределах TOOL_OUTPUT_BUDGET байт."""
+    if isinstance(result, str) and len(result.encode("utf-8")) > TOOL_OUTPUT_BUDGET:
+        result = result.encode("utf-8")[:TOOL_OUTPUT_BUDGET].decode("utf-8", "ignore") + "…"
+    if not isinstance(result, Page):
+        return json.dumps(result, ensure_ascii=False)
+    records = []
+    next_cursor = result.next_cursor
+    size = len('{"items": [], "next_cursor": 0000000000}')
+    for record, cursor in zip(result.records, result.cursors):
+        encoded = len(json.dumps(record, ensure_ascii=False).encode("utf-8")) + 2
+        if records and size + encoded > TOOL_OUTPUT_BUDGET:
+            next_cursor = cursor
+            break
+        records.append(record)
+        size += encoded
+    output = {"items": records}
+    if next_cursor is not None:
+        output["next_cursor"] = next_cursor
+    return json.dumps(output, ensure_ascii=False)
+
+
+def handle_search_items(query, category_id=None, limit=SEARCH_DEFAULT_LIMIT):
+    if category_id is not None and str(category_id) not in info:
         return f"Категория с id {category_id} не найдена."
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    catalog.index_pending()
     return [
-        {"id": item["id"], "description": item["description"], "cost": item["cost"], "cost_name": item.get("cost_name", "штукарики")}
-        for item in info[str(category_id)]
+        {"category_id": int(found_category), "id": item.id, "description": item.description,
+         "cost": item.cost, "cost_name": item.cost_name, "score": round(score, 3)}
+        for score, found_category, item in search_index.search(query, category_id, limit)
     ]
 
 
-def save_purchase_history(user_id, category_id, item):
-    try:
-        if os.path.exists(PURCHASE_HISTORY_FILE):
-            with open(PURCHASE_HISTORY_FILE, "r", encoding="utf-8") as f:
-                history = json.load(f)
+def handle_show_items(category_id, cursor=None, limit=TOOL_PAGE_SIZE):
+    """Записи категории по возрастанию id, начиная с id == cursor."""
+    if str(category_id) not in info:
+        return f"Категория с id {category_id} не найдена."
+    items = info[str(category_id)]
+    start = bisect.bisect_left(items, cursor, key=lambda item: item.id) if cursor else 0
+    page = items[start:start + page_size(limit)]
+    return Page(
+        [{"id": item.id, "description": item.description, "cost": item.cost, "cost_name": item.cost_name}
+         for item in page],
+        [item.id for item in page],
+        items[start + len(page)].id if start + len(page) < len(items) else None
+    )
+
+
+def handle_get_item_details(user_id, category_id, item_id, offset=0):
+    """Кусок details купленной или проданной игроком записи, начиная с offset."""
+    item = catalog.get(category_id, item_id)
+    if not item:
+        return "В категории не найдена информация с заданным id"
+    if item.seller_id != user_id and not purchase_history.bought(user_id, category_id, item_id):
+        return "Подробности доступны только после покупки информации"
+    details = item.details
+    offset = max(offset, 0)
+    result = {"category_id": category_id, "id": item_id, "offset": offset,
+              "details": details[offset:offset + TOOL_DETAILS_CHUNK]}
+    if offset + TOOL_DETAILS_CHUNK < len(details):
+        result["next_offset"] = offset + TOOL_DETAILS_CHUNK
+    return result
+
+
+# Сколько последних покупок по умолчанию отдаёт get_user_purchase_history
+HISTORY_PAGE_SIZE = 20
+
+
+class PurchaseHistory:
+    """История покупок в памяти с индексом по пользователю и категории.
+
+    Файл читается при импорте, как users и info: в режиме воркеров загрузка
+    может ждать блокировку общего хранилища, и делать это в цикле событий нельзя.
+    Новые покупки дописываются в журнал хранилища по одной записи.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._data = {
+            user_id: [Purchase.from_json(data) for data in records]
+            for user_id, records in load_data(file_path).items()
+        }
+        storage.attach(file_path, self._data)
+        storage.subscribe(file_path, self._apply_remote)
+        # (user_id, category_id) -> позиции покупок в списке пользователя
+        self._by_category = {}
+        for user_id, records in self._data.items():
+            for idx, record in enumerate(records):
+                self._by_category.setdefault((user_id, str(record.category_id)), []).append(idx)
+
+    def _apply_remote(self, path, value):
+        """Покупка, записанная другим воркером."""
+        user_id = path[0]
+        records = self._data.setdefault(user_id, [])
+        new = [Purchase.from_json(data) for data in value] if len(path) == 1 else [Purchase.from_json(value)]
+        start = 0 if len(path) == 1 else path[1]
+        for position, record in enumerate(new, start):
+            if position < len(records):
+                continue
+            records.append(record)
+            self._by_category.setdefault((user_id, str(record.category_id)), []).append(position)
+
+    def add(self, user_id, record, tx=None):
+        data = self._data
+        user_id = str(user_id)
+        position = len(data.get(user_id, []))
+
+        def index():
+            self._by_category.setdefault((user_id, str(record.category_id)), []).append(position)
+
+        if user_id not in data:
+            save_change(self.file_path, [user_id], [record], tx)
         else:
-            history = {}
-        user_id_str = str(user_id)
-        if user_id_str not in history:
-            history[user_id_str] = []
-        history[user_id_str].append({
-            "category_id": category_id,
-            "id": item["id"],
-            "description": item["description"],
-            "details": item["details"],
-            "cost": item["cost"],
-            "cost_name": item.get("cost_name", "штукарики")
-        })
-        with open(PURCHASE_HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        general_logger.error(f"Ошибка при сохранении purchase_history: {e}")
+            save_change(self.file_path, [user_id, position], record, tx)
+        if tx is not None:
+            tx.on_commit.append(index)
+        else:
+            index()
+
+    def bought(self, user_id, category_id, item_id):
+        records = self._data.get(str(user_id), [])
+        positions = self._by_category.get((str(user_id), str(category_id)), [])
+        return any(records[idx].id == item_id for idx in positions)
 
-def get_user_purchase_history(user_id):
+    def page(self, user_id, category_id=None, before=None, limit=HISTORY_PAGE_SIZE):
+        """Покупки от новых к старым с позицией меньше before: список (позиция, запись).
+
+        Позиции в списке игрока не меняются, поэтому годятся как курсор.
+        """
+        records = self._data.get(str(user_id), [])
+        if category_id is None:
+            positions = range(len(records))
+        else:
+            positions = self._by_category.get((str(user_id), str(category_id)), [])
+        end = bisect.bisect_left(positions, before) if before is not None else len(positions)
+        return [(idx, records[idx]) for idx in reversed(positions[max(end - limit, 0):end])]
+
+
+purchase_history = PurchaseHistory(PURCHASE_HISTORY_FILE)
+
+
+def save_purchase_history(user_id, category_id, item, tx=None):
+    purchase_history.add(user_id, Purchase.from_item(category_id, item), tx)
+
+def get_user_purchase_history(user_id, limit=HISTORY_PAGE_SIZE, cursor=None, category_id=None):
+    """Покупки игрока от новых к старым; cursor — позиция, до которой продолжать."""
     try:
-        if not os.path.exists(PURCHASE_HISTORY_FILE):
-            return []
-        with open(PURCHASE_HISTORY_FILE, "r", encoding="utf-8") as f:
-            history = json.load(f)
-        return history.get(str(user_id), [])
+        found = purchase_history.page(user_id, category_id, cursor, page_size(limit))
+        has_more = bool(found) and bool(purchase_history.page(user_id, category_id, found[-1][0], 1))
     except Exception as e:
         return f"Ошибка при получении purchase_history: {e}"
+    records = []
+    for _, record in found:
+        data = record.to_json()
+        records.append(clip_field(data, "details", data["details"], record.category_id, record.id))
+    return Page(records, [position + 1 for position, _ in found], found[-1][0] if has_more else None)
 
 def handle_buy_item(user_id, category_id, item_id):
     if str(category_id) not in info:
         return f"Категория с id {category_id} не найдена."
-    item = next((x for x in info[str(category_id)] if x["id"] == item_id), None)
+    item = catalog.get(category_id, item_id)
     if not item:
         return "В категории не найдена информация с заданным id"
     user = get_user(user_id)
-    if user["balance"] < item["cost"]:
-        return "Недостаточно кредитов на балансе"
-    update_balance(user_id, -item["cost"])
-    log_operation(f'{user["name"]} ({user_id}) купил информацию: {item["description"]} ({item["details"]}), за {item["cost"]} {item.get("cost_name", "штукарики")}.')
-    save_purchase_history(user_id, category_id, item)
-    return f"Информация успешно куплена за {item['cost']}, вот её описание {item['details']}"
+    # Проверка баланса, списание и запись в историю — одной транзакцией
+    with Transaction() as tx:
+        if user.balance < item.cost:
+            return "Недостаточно кредитов на балансе"
+        update_balance(user_id, -item.cost, tx)
+        save_purchase_history(user_id, category_id, item, tx)
+    details = item.details
+    log_operation(f'{user.name} ({user_id}) купил информацию: {item.description} ({details}), за {item.cost} {item.cost_name}.')
+    return f"Информация успешно куплена за {item.cost}, вот её описание {details}"
 
 
 def handle_sell_item(user_id, description, details, cost, category_id, cost_name="штукарики"):
@@ -221,76 +1569,502 @@ def handle_sell_item(user_id, description, details, cost, category_id, cost_name
         пояснения.append("(нельзя продать дешевле 1 кредита, цена скорректирована до 1)")
     if len(details) < 200:
         return "ОШИБКА: Описание информации слишком короткое (меньше 200 символов). Пожалуйста, опишите информацию подробнее."
-    new_id = add_info(category_id, user_id, user["name"], description, details, cost, cost_name)
-    update_balance(user_id, cost)
-    log_operation(f'{user["name"]} ({user_id}) продал информацию: {description} ({details}), за {cost} {cost_name} (категория {category_id}, id {new_id}).')
+    # Информация попадает в каталог только вместе с выплатой продавцу. Проверка на дубль
+    # идёт в той же транзакции: с общим хранилищем она видит записи, проданные другими
+    # воркерами, иначе две одновременные продажи одного текста обе её пройдут
+    with Transaction() as tx:
+        # Пересказы уже известной информации не покупаем
+        catalog.index_pending()
+        similar = duplicate_index.most_similar(details)
+        if similar and similar[0] >= DUPLICATE_REJECT_THRESHOLD:
+            similarity, similar_category, similar_item = similar
+            log_operation(f'{user.name} ({user_id}) пытался продать дубль записи {similar_category}/{similar_item.id} '
+                          f'(похожесть {similarity:.2f}): {description}')
+            return (f"ОШИБКА: Эта информация почти совпадает с уже известной мне записью «{similar_item.description}» "
+                    f"(категория {similar_category}, id {similar_item.id}). Повторно её не покупаю.")
+        new_id = add_info(category_id, user_id, user.name, description, details, cost, cost_name, tx)
+        update_balance(user_id, cost, tx)
+    log_operation(f'{user.name} ({user_id}) продал информацию: {description} ({details}), за {cost} {cost_name} (категория {category_id}, id {new_id}).')
+    if similar and similar[0] >= DUPLICATE_FLAG_THRESHOLD:
+        log_operation(f'Возможный дубль: запись {category_id}/{new_id} похожа на {similar[1]}/{similar[2].id} '
+                      f'(похожесть {similar[0]:.2f})')
     пояснение = " ".join(пояснения)
-    return f"Информация продана за {cost} {cost_name}. {пояснение} Ваш новый баланс: {users[user_id]['balance']} {cost_name}."
+    return f"Информация продана за {cost} {cost_name}. {пояснение} Ваш новый баланс: {users[user_id].balance} {cost_name}."
 
 
-def handle_get_purchased_items(user_id):
+def handle_get_purchased_items(user_id, cursor=0, limit=TOOL_PAGE_SIZE):
     # Вернуть список купленных описаний и деталей по всем категориям
-    purchased = []
-    for cat_id, items in info.items():
-        for item in items:
-            if item.get("seller_id") == user_id:
-                purchased.append({
-                    "description": item["description"],
-                    "details": item["details"]
-                })
-    return purchased
-
-async def get_info_from_category(category_id, user_id, context):
+    records = catalog.by_seller(user_id)
+    start = max(cursor or 0, 0)
+    page = records[start:start + page_size(limit)]
+    return Page(
+        [clip_field({"category_id": int(cat_id), "id": item.id, "description": item.description},
+                    "details", item.details, cat_id, item.id)
+         for cat_id, item in page],
+        list(range(start, start + len(page))),
+        start + len(page) if start + len(page) < len(records) else None
+    )
+
+async def get_info_from_category(category_id, user_id, context, cursor=1, limit=TOOL_PAGE_SIZE):
     if str(category_id) not in info:
         return f"Категория {category_id} не найдена."
     category_name = CATEGORY_NAMES.get(str(category_id), f"Категория {category_id}")
     items = info[str(category_id)]
     if not items:
         return f"В категории '{category_name}' пока нет информации."
+    start = max(cursor or 1, 1)
     items_json = []
-    for idx, item in enumerate(items, 1):
+    for idx, item in enumerate(items[start - 1:start - 1 + page_size(limit)], start):
         items_json.append({
             "id": idx,
-            "description": item.get("description", "<без описания>"),
-            "cost": item.get("cost", 0),
-            "cost_name": item.get("cost_name", "штукарики")
+            "description": item.description,
+            "cost": item.cost,
+            "cost_name": item.cost_name
         })
 
-    return items_json
+    end = start + len(items_json)
+    return Page(items_json, list(range(start, end)), end if end <= len(items) else None)
 
 
 
-def get_random_info_about_world():
-    try:
-        with open(INFO_ABOUT_WORLD_FILE, "r", encoding="utf-8") as f:
+# Не чаще чем раз в столько секунд проверяем, не изменился ли файл фактов
+FACTS_RECHECK_INTERVAL = 5
+
+
+class FactsProvider:
+    """Факты о мире из JSON-файла, закэшированные в памяти.
+
+    Файл перечитывается, только если изменился его mtime, а mtime проверяется
+    не чаще раза в recheck_interval секунд. Каждый игрок получает факты без
+    повторов, пока не пройдёт весь набор. Факт — строка или объект
+    {"text": ..., "weight": ...}; факты с большим весом выпадают раньше.
+    """
+
+    def __init__(self, file_path, recheck_interval=FACTS_RECHECK_INTERVAL):
+        self.file_path = file_path
+        self.recheck_interval = recheck_interval
+        self.facts = []
+        self.weights = []
+        self._mtime = None
+        self._checked_at = None
+        # user_id -> индексы ещё не выданных фактов (следующий — последний)
+        self._decks = {}
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.recheck_interval:
+            return
+        self._checked_at = now
+        mtime = os.stat(self.file_path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with open(self.file_path, "r", encoding="utf-8") as f:
             facts = json.load(f)
-        if not isinstance(facts, list) or not facts:
+        if not isinstance(facts, list):
+            facts = []
+        self.facts = [fact["text"] if isinstance(fact, dict) else fact for fact in facts]
+        self.weights = [float(fact.get("weight", 1)) if isinstance(fact, dict) else 1.0 for fact in facts]
+        self._mtime = mtime
+        self._decks.clear()
+
+    def _new_deck(self):
+        # Взвешенная перестановка без повторов (Efraimidis–Spirakis)
+        keys = [random.random() ** (1 / weight) if weight > 0 else 0.0 for weight in self.weights]
+        return sorted(range(len(self.facts)), key=keys.__getitem__)
+
+    def get(self, user_id=None):
+        """Следующий факт для игрока или None, если фактов нет."""
+        self._refresh()
+        if not self.facts:
+            return None
+        deck = self._decks.get(user_id)
+        if not deck:
+            deck = self._decks[user_id] = self._new_deck()
+        return self.facts[deck.pop()]
+
+
+facts_provider = FactsProvider(INFO_ABOUT_WORLD_FILE)
+
+
+def get_random_info_about_world(user_id=None):
+    try:
+        fact = facts_provider.get(user_id)
+        if fact is None:
             return "Нет фактов о мире."
-        return random.choice(facts)
+        return fact
     except Exception as e:
         return f"Ошибка при получении факта о мире: {e}"
+# ------------------------------------------------------------------------------
+# Инструменты ассистента
+# ------------------------------------------------------------------------------
+class Tool:
+    def __init__(self, name, handler, params, read_only, cacheable):
+        self.name = name
+        self.handler = handler
+        self.params = params
+        self.read_only = read_only
+        self.cacheable = cacheable
+
+
+TOOLS = {}
+# Время выполнения инструментов: имя -> {"calls", "errors", "total", "max"}
+tool_timings = {}
+PARAM_TYPE_NAMES = {int: "целым числом", str: "строкой"}
+
+
+def tool(name, params=None, read_only=False, cacheable=False):
+    """Регистрирует функцию как инструмент ассистента.
+
+    params: имя аргумента -> (тип, обязателен ли). Функция вызывается как
+    handler(user_id, context, **аргументы). Асинхронные read_only-инструменты из
+    одной пачки выполняются параллельно; cacheable — ответ зависит только от каталога и
+    аргументов и кэшируется в tool_cache.
+    """
+    def register(handler):
+        TOOLS[name] = Tool(name, handler, params or {}, read_only, cacheable)
+        return handler
+    return register
+
+
+@tool("sell_item", {
+    "description": (str, True),
+    "details": (str, True),
+    "cost": (int, True),
+    "category_id": (int, True),
+    "cost_name": (str, False),
+})
+async def tool_sell_item(user_id, context, description, details, cost, category_id, cost_name="штукарики"):
+    # Пока каталог индексируется в фоне, проверка на дубль ждёт его, не блокируя цикл
+    await catalog.catch_up()
+    return await call_with_storage_retry(handle_sell_item, user_id, description, details, cost, category_id, cost_name)
+
+
+@tool("buy_item", {"category_id": (int, True), "item_id": (int, True)})
+def tool_buy_item(user_id, context, category_id, item_id):
+    return handle_buy_item(user_id, category_id, item_id)
+
+
+@tool("get_items_for_category", {
+    "category_id": (int, True),
+    "cursor": (int, False),
+    "limit": (int, False),
+}, read_only=True, cacheable=True)
+def tool_get_items_for_category(user_id, context, category_id, cursor=None, limit=TOOL_PAGE_SIZE):
+    return handle_show_items(category_id, cursor, limit)
+
+
+@tool("get_item_details", {
+    "category_id": (int, True),
+    "item_id": (int, True),
+    "offset": (int, False),
+}, read_only=True)
+def tool_get_item_details(user_id, context, category_id, item_id, offset=0):
+    return handle_get_item_details(user_id, category_id, item_id, offset)
+
+
+@tool("search_items", {
+    "query": (str, True),
+    "category_id": (int, False),
+    "limit": (int, False),
+}, read_only=True, cacheable=True)
+async def tool_search_items(user_id, context, query, category_id=None, limit=SEARCH_DEFAULT_LIMIT):
+    await catalog.catch_up()
+    return handle_search_items(query, category_id, limit)
+
+
+@tool("get_purchased_items", {"cursor": (int, False), "limit": (int, False)}, read_only=True)
+def tool_get_purchased_items(user_id, context, cursor=0, limit=TOOL_PAGE_SIZE):
+    return handle_get_purchased_items(user_id, cursor, limit)
+
+
+@tool("get_categories_with_counts", read_only=True, cacheable=True)
+def tool_get_categories_with_counts(user_id, context):
+    return get_categories_with_counts()
+
+
+@tool("get_info_from_category", {
+    "category_id": (int, True),
+    "cursor": (int, False),
+    "limit": (int, False),
+}, read_only=True, cacheable=True)
+async def tool_get_info_from_category(user_id, context, category_id, cursor=1, limit=TOOL_PAGE_SIZE):
+    return await get_info_from_category(category_id, user_id, context, cursor, limit)
+
+
+@tool("get_random_info_about_world", read_only=True)
+def tool_get_random_info_about_world(user_id, context):
+    return get_random_info_about_world(user_id)
+
+
+@tool("get_user_purchase_history", {
+    "limit": (int, False),
+    "cursor": (int, False),
+    "category_id": (int, False),
+}, read_only=True)
+def tool_get_user_purchase_history(user_id, context, limit=HISTORY_PAGE_SIZE, cursor=None, category_id=None):
+    return get_user_purchase_history(user_id, limit, cursor, category_id)
+
+
+def validate_tool_call(name, raw_arguments):
+    """Находит инструмент и проверяет аргументы; при ошибке — ValueError с пояснением."""
+    tool = TOOLS.get(name)
+    if tool is None:
+        raise ValueError("Unknown function call.")
+    try:
+        arguments = json.loads(raw_arguments or "{}")
+    except json.JSONDecodeError:
+        raise ValueError(f"Ошибка: аргументы {name} не являются корректным JSON")
+    if not isinstance(arguments, dict):
+        raise ValueError(f"Ошибка: аргументы {name} должны быть объектом")
+    validated = {}
+    for param, (param_type, required) in tool.params.items():
+        if arguments.get(param) is None:
+            if required:
+                raise ValueError(f"Ошибка: не указан обязательный аргумент {param}")
+            continue
+        try:
+            validated[param] = param_type(arguments[param])
+        except (TypeError, ValueError):
+            raise ValueError(f"Ошибка: аргумент {param} должен быть {PARAM_TYPE_NAMES[param_type]}")
+    return tool, validated
+
+
+def record_tool_timing(name, elapsed, failed=False):
+    timing = tool_timings.setdefault(name, {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0})
+    timing["calls"] += 1
+    timing["errors"] += failed
+    timing["total"] += elapsed
+    timing["max"] = max(timing["max"], elapsed)
+
+
+async def run_tool(tool, arguments, user_id, context):
+    """Выполняет инструмент и возвращает результат в виде JSON-строки."""
+    cache_key = (tool.name, tuple(sorted(arguments.items()))) if tool.cacheable else None
+    started = time.perf_counter()
+    if cache_key:
+        output = tool_cache.lookup(cache_key)
+        if output is not None:
+            general_logger.info("Tool %s result from cache", tool.name)
+            record_tool_timing(tool.name, time.perf_counter() - started)
+            return output
+    general_logger.info("Executing tool: %s with args: %s", tool.name, arguments)
+    failed = False
+    try:
+        if asyncio.iscoroutinefunction(tool.handler):
+            result = await tool.handler(user_id, context, **arguments)
+        else:
+            # Синхронные обработчики — быстрые операции над данными в памяти, которые
+            # не рассчитаны на потоки; выполняем их прямо в цикле событий
+            result = await call_with_storage_retry(tool.handler, user_id, context, **arguments)
+    except Exception as e:
+        general_logger.error(f"Tool {tool.name} failed: {e}")
+        result = f"Ошибка при выполнении {tool.name}: {e}"
+        failed = True
+    elapsed = time.perf_counter() - started
+    record_tool_timing(tool.name, elapsed, failed)
+    general_logger.info("Tool %s result (%.1f ms): %s", tool.name, elapsed * 1000, log_payload(result))
+    output = render_tool_output(result)
+    if cache_key and not failed:
+        tool_cache.store(cache_key, output)
+    return output
+
+
 # ------------------------------------------------------------------------------
 # Функции взаимодействия с OpenAI Threads
 # ------------------------------------------------------------------------------
-def add_message_to_thread(client, thread_id, role, content, user_id=None):
+# Сколько последних реплик каждого потока держим в памяти
+THREAD_CACHE_TURNS = 20
+# Реплики в кэше обрезаются до стольких символов
+THREAD_CACHE_TEXT_LIMIT = 1000
+# Сколько сообщений запрашивать, если курсор потока неизвестен (например, после перезапуска)
+THREAD_FALLBACK_PAGE = 20
+
+
+def message_text(msg):
+    """Текст сообщения потока (первый текстовый блок content)."""
+    if msg.content and isinstance(msg.content, list):
+        return msg.content[0].text.value
+    return str(msg.content)
+
+
+class ThreadHistory:
+    """Последнее увиденное сообщение и недавние реплики каждого потока.
+
+    Зная id последнего сообщения, после run можно запросить только более
+    новые сообщения (messages.list с after), а не всю страницу потока.
+    """
+
+    def __init__(self, max_turns=THREAD_CACHE_TURNS):
+        self.max_turns = max_turns
+        self._last_seen = {}
+        self._turns = {}
+        # Сколько сообщений потока мы видели с момента запуска
+        self._counts = {}
+
+    def remember(self, thread_id, msg):
+        self._last_seen[thread_id] = msg.id
+        self._counts[thread_id] = self._counts.get(thread_id, 0) + 1
+        turns = self._turns.get(thread_id)
+        if turns is None:
+            turns = self._turns[thread_id] = deque(maxlen=self.max_turns)
+        turns.append((msg.role, message_text(msg)[:THREAD_CACHE_TEXT_LIMIT]))
+
+    def last_seen(self, thread_id):
+        return self._last_seen.get(thread_id)
+
+    def turns(self, thread_id):
+        return list(self._turns.get(thread_id, ()))
+
+    def count(self, thread_id):
+        return self._counts.get(thread_id, 0)
+
+
+thread_history = ThreadHistory()
+
+# Как долго считаем поток проверенным после threads.retrieve или записи в него, с
+THREAD_VALIDATION_TTL = 3600
+# После скольких сообщений поток заменяется новым со сводкой
+THREAD_MAX_MESSAGES = 60
+# Сколько последних реплик попадает в сводку и до скольких символов они обрезаются
+THREAD_SUMMARY_TURNS = 6
+THREAD_SUMMARY_TEXT_LIMIT = 200
+
+
+class ThreadManager:
+    """Ленивое создание, проверка и ротация потоков игроков.
+
+    Поток создаётся при первом сообщении игрока, а не при регистрации или /start.
+    threads.retrieve вызывается, только если поток не проверялся дольше ttl;
+    успешная запись в поток тоже считается проверкой. Когда в потоке набирается
+    max_messages сообщений, игрок переходит на новый поток, куда переносится
+    короткая сводка последних реплик.
+    """
+
+    def __init__(self, ttl=THREAD_VALIDATION_TTL, max_messages=THREAD_MAX_MESSAGES):
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self._validated = {}
+
+    def touch(self, thread_id):
+        self._validated[thread_id] = time.monotonic()
+
+    def _is_fresh(self, thread_id):
+        validated_at = self._validated.get(thread_id)
+        return validated_at is not None and time.monotonic() - validated_at < self.ttl
+
+    async def ensure_thread(self, client, user_id):
+        """thread_id, в который можно писать сообщения игрока."""
+        thread_id = get_user(user_id).thread_id
+        if thread_id and not self._is_fresh(thread_id):
+            try:
+                await client.beta.threads.retrieve(thread_id=thread_id)
+                self.touch(thread_id)
+            except openai.NotFoundError as e:
+                general_logger.error(f"Не удалось получить существующий поток: {e}")
+                thread_id = None
+            except Exception as e:
+                # Временная ошибка API — не теряем контекст, пробуем писать в старый поток
+                general_logger.warning(f"Не удалось проверить поток {thread_id}: {e}")
+        if not thread_id:
+            return await self._create(client, user_id)
+        if thread_history.count(thread_id) >= self.max_messages:
+            return await self._create(client, user_id, self.summary(thread_id))
+        return thread_id
+
+    def summary(self, thread_id):
+        lines = []
+        for role, text in thread_history.turns(thread_id)[-THREAD_SUMMARY_TURNS:]:
+            speaker = "Игрок" if role == "user" else "Меняла"
+            lines.append(f"{speaker}: {text[:THREAD_SUMMARY_TEXT_LIMIT]}")
+        if not lines:
+            return None
+        return "Краткое содержание предыдущего разговора:\n" + "\n".join(lines)
+
+    async def _create(self, client, user_id, summary=None):
+        messages = [{"role": "assistant", "content": summary}] if summary else []
+        thread = await client.beta.threads.create(messages=messages)
+        await call_with_storage_retry(save_change, USERS_FILE, [user_id, "thread_id"], thread.id)
+        self.touch(thread.id)
+        get_user_logger(user_id).info(
+            "Поток заменён новым со сводкой" if summary else "Создан новый поток (thread) для пользователя"
+        )
+        return thread.id
+
+
+thread_manager = ThreadManager()
+
+# Сколько заметок о быстрых командах держим на игрока до следующего run
+THREAD_NOTES_LIMIT = 20
+
+
+class ThreadNotes:
+    """Заметки о действиях игрока через быстрые команды (/balance, /buy, ...).
+
+    Команды отвечают без ассистента; заметки уходят в поток одним сообщением
+    перед следующим run игрока, чтобы ассистент знал о покупках и просмотрах.
+    """
+
+    def __init__(self):
+        self._notes = {}
+
+    def add(self, chat_id, text):
+        self._notes.setdefault(chat_id, deque(maxlen=THREAD_NOTES_LIMIT)).append(text)
+
+    def pop(self, chat_id):
+        notes = self._notes.pop(chat_id, None)
+        if not notes:
+            return None
+        return "[Служебная заметка: игрок воспользовался командами бота]\n" + "\n".join(f"- {note}" for note in notes)
+
+
+thread_notes = ThreadNotes()
+
+
+async def fetch_new_assistant_messages(client, thread_id):
+    """Ответы ассистента, появившиеся в потоке после последнего увиденного сообщения."""
+    cursor = thread_history.last_seen(thread_id)
+    if cursor is not None:
+        messages = [msg async for msg in client.beta.threads.messages.list(thread_id=thread_id, after=cursor, order="asc")]
+        general_logger.info("Retrieved %d new messages from thread", len(messages))
+        assistant_msgs = [msg for msg in messages if msg.role == "assistant"]
+    else:
+        messages = (await client.beta.threads.messages.list(thread_id=thread_id, limit=THREAD_FALLBACK_PAGE)).data
+        general_logger.info("Retrieved %d messages from thread", len(messages))
+        # Фильтруем все подряд идущие с конца сообщения ассистента до первого user
+        assistant_msgs = []
+        for msg in messages:
+            if msg.role == "assistant":
+                assistant_msgs.append(msg)
+            elif msg.role == "user":
+                break
+        # Отправим их в обратном порядке (от старого к новому)
+        assistant_msgs = list(reversed(assistant_msgs))
+    for msg in assistant_msgs:
+        thread_history.remember(thread_id, msg)
+    return assistant_msgs
+
+
+async def add_message_to_thread(client, thread_id, role, content, user_id=None):
     """Добавляет сообщение в указанный поток."""
     user_info = ""
     if user_id:
         user = get_user(user_id)
-        user_info = f" ({user['name']}, баланс: {user['balance']})"
+        user_info = f" ({user.name}, баланс: {user.balance})"
     message_content = f"{content}{user_info}"
-    logging.info(f"Adding message to thread {thread_id}: {role} - {message_content}")
-    client.beta.threads.messages.create(
+    general_logger.info("Adding message to thread %s: %s - %s", thread_id, role, log_payload(message_content))
+    message = await client.beta.threads.messages.create(
         thread_id=thread_id,
         role=role,
         content=message_content
     )
+    thread_manager.touch(thread_id)
+    thread_history.remember(thread_id, message)
 
 
-def submit_tool_outputs(client, thread_id, run_id, tool_outputs):
+async def submit_tool_outputs(client, thread_id, run_id, tool_outputs):
     """Отправляет результаты выполнения 'инструментов' (tool calls) в поток."""
-    logging.info(f"Submitting tool outputs for run {run_id} in thread {thread_id}: {tool_outputs}")
-    response = client.beta.threads.runs.submit_tool_outputs(
+    general_logger.info("Submitting tool outputs for run %s in thread %s: %s", run_id, thread_id, log_payload(tool_outputs))
+    response = await client.beta.threads.runs.submit_tool_outputs(
         thread_id=thread_id,
         run_id=run_id,
         tool_outputs=tool_outputs
@@ -298,10 +2072,22 @@ def submit_tool_outputs(client, thread_id, run_id, tool_outputs):
     return response
 
 
-async def run_assistant(client, thread_id, assistant_id, user_id, context):
-    """Запускает ассистента на указанном потоке и обрабатывает его ответы."""
-    logging.info(f"Running assistant {assistant_id} on thread {thread_id}")
-    run = client.beta.threads.runs.create(
+# Получать ход run через streaming API (иначе — опрос runs.retrieve)
+RUN_STREAMING = True
+# Опрос статуса run: начальная пауза, множитель и потолок паузы (секунды)
+RUN_POLL_INITIAL_DELAY = 0.3
+RUN_POLL_BACKOFF = 1.5
+RUN_POLL_MAX_DELAY = 3
+# Сколько всего ждём ответа ассистента, прежде чем отменить run
+RUN_TIMEOUT = 90
+RUN_FAILED_EVENTS = ["thread.run.cancelling", "thread.run.cancelled", "thread.run.failed",
+                     "thread.run.incomplete", "thread.run.expired"]
+RUN_ERROR_REPLY = [{"error": "❌ ОШИБКА: Не удалось получить ответ от ассистента. Попробуйте позже."}]
+
+
+def run_options(thread_id, assistant_id):
+    """Параметры, с которыми создаётся каждый run."""
+    return dict(
         thread_id       = thread_id,
         assistant_id    = assistant_id,
         truncation_strategy={
@@ -311,107 +2097,926 @@ async def run_assistant(client, thread_id, assistant_id, user_id, context):
         max_completion_tokens = 1024    # опционально
     )
 
+
+async def execute_tool_calls(tool_calls, user_id, context, state):
+    """Выполняет tool calls ассистента и возвращает tool_outputs для отправки.
+
+    state["outputs"] — уже посчитанные результаты (tool_call_id -> output): если стрим
+    оборвался после выполнения, при переходе на опрос покупка не выполнится второй раз.
+    Время выполнения добавляется к state["tool_time"].
+    """
+    general_logger.info("Processing %d tool calls", len(tool_calls))
+    started = time.monotonic()
+    done = state["outputs"]
+    # Сначала проверяем аргументы всех вызовов пачки
+    calls = []
+    for tool_call in tool_calls:
+        if tool_call.id in done:
+            continue
+        try:
+            tool, arguments = validate_tool_call(tool_call.function.name, tool_call.function.arguments)
+        except ValueError as e:
+            general_logger.warning(f"Tool call {tool_call.function.name} rejected: {e}")
+            done[tool_call.id] = json.dumps(str(e), ensure_ascii=False)
+            continue
+        calls.append((tool_call.id, tool, arguments))
+
+    # Подряд идущие read-only вызовы выполняются параллельно, изменяющие — по порядку
+    parallel = []
+    for call in calls + [None]:
+        if call is not None and call[1].read_only:
+            parallel.append(call)
+            continue
+        if parallel:
+            outputs = await asyncio.gather(*(run_tool(t, args, user_id, context) for _, t, args in parallel))
+            for (call_id, _, _), output in zip(parallel, outputs):
+                done[call_id] = output
+            parallel = []
+        if call is not None:
+            call_id, t, args = call
+            done[call_id] = await run_tool(t, args, user_id, context)
+
+    state["tool_time"] += time.monotonic() - started
+    return [{"tool_call_id": tool_call.id, "output": done[tool_call.id]} for tool_call in tool_calls]
+
+
+async def stream_run(client, thread_id, assistant_id, user_id, context, state):
+    """Ведёт run через streaming API, обрабатывая события по мере поступления.
+
+    Tool calls выполняются сразу по событию requires_action, ответы ассистента
+    собираются из событий thread.message.completed, так что messages.list не нужен.
+    id созданного run кладётся в state["run_id"], расход токенов — в state["usage"],
+    полученные ответы — в state["messages"]: если стрим оборвётся, их вернёт poll_run.
+    """
+    manager = client.beta.threads.runs.stream(**run_options(thread_id, assistant_id))
+    assistant_msgs = state["messages"]
+    while manager is not None:
+        next_manager = None
+        async with manager as stream:
+            async for event in stream:
+                if state["first_status"] is None:
+                    state["first_status"] = time.monotonic() - state["started"]
+                if event.event == "thread.run.created":
+                    state["run_id"] = event.data.id
+                elif event.event == "thread.message.completed" and event.data.role == "assistant":
+                    assistant_msgs.append(event.data)
+                    thread_history.remember(thread_id, event.data)
+                elif event.event == "thread.run.requires_action":
+                    run = event.data
+                    general_logger.warning(f"Run requires action: {run.required_action}")
+                    tool_outputs = await execute_tool_calls(
+                        run.required_action.submit_tool_outputs.tool_calls, user_id, context, state
+                    )
+                    general_logger.info("Submitting tool outputs for run %s in thread %s: %s", run.id, thread_id, log_payload(tool_outputs))
+                    next_manager = client.beta.threads.runs.submit_tool_outputs_stream(
+                        thread_id=thread_id,
+                        run_id=run.id,
+                        tool_outputs=tool_outputs
+                    )
+                elif event.event == "thread.run.completed":
+                    general_logger.info("Run completed successfully, %d assistant messages", len(assistant_msgs))
+                    general_logger.debug("Run costs %s", event.data.usage)
+                    state["usage"] = event.data.usage
+                elif event.event in RUN_FAILED_EVENTS:
+                    general_logger.error(f"Run ended with status: {event.data.status}")
+                    if event.data.last_error:
+                        general_logger.error(f"Last error: {event.data.last_error}")
+                    return []
+                elif event.event == "error":
+                    general_logger.error(f"Stream error: {event.data}")
+                    return []
+        manager = next_manager
+    return assistant_msgs
+
+
+async def poll_run(client, thread_id, run, user_id, context, state):
+    """Опрашивает run с нарастающей паузой, пока он не завершится."""
+    delay = RUN_POLL_INITIAL_DELAY
     iteration = 0
     while True:
         iteration += 1
-        if iteration > 30:
-            general_logger.error(f"Run for thread {thread_id} exceeded 30 iterations, cancelling.")
-            try:
-                client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-            except Exception as e:
-                general_logger.error(f"Error cancelling run: {e}")
-            return [{"error": "❌ ОШИБКА: Не удалось получить ответ от ассистента. Попробуйте позже."}]
-        await asyncio.sleep(3)
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-        general_logger.info(f"Iteration {iteration}: Run status: {run.status}")
+        await asyncio.sleep(delay)
+        delay = min(delay * RUN_POLL_BACKOFF, RUN_POLL_MAX_DELAY)
+        run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        general_logger.info("Iteration %d: Run status: %s", iteration, run.status)
+        if state["first_status"] is None:
+            state["first_status"] = time.monotonic() - state["started"]
 
         if run.status in ["queued", "in_progress"]:
-            general_logger.info(f"Run still in progress (iteration {iteration}), waiting...")
             continue
         elif run.status == "requires_action":
             general_logger.warning(f"Run requires action: {run.required_action}")
-            tool_calls = run.required_action.submit_tool_outputs.tool_calls
-            general_logger.info(f"Processing {len(tool_calls)} tool calls")
-            tool_outputs = []
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                arguments = json.loads(tool_call.function.arguments)
-                general_logger.info(f"Executing tool: {function_name} with args: {arguments}")
-                
-                if function_name == "sell_item":
-                    result = handle_sell_item(
-                        user_id,
-                        arguments["description"],
-                        arguments["details"],
-                        arguments["cost"],
-                        int(arguments["category_id"]),
-                        arguments.get("cost_name", "штукарики")
-                    )
-                elif function_name == "buy_item":
-                    result = handle_buy_item(
-                        user_id,
-                        int(arguments["category_id"]),
-                        arguments["item_id"]
-                    )
-                elif function_name == "get_items_for_category":
-                    result = handle_show_items(int(arguments["category_id"]))
-                elif function_name == "get_purchased_items":
-                    result = handle_get_purchased_items(user_id)
-                elif function_name == "get_categories_with_counts":
-                    result = get_categories_with_counts()
-                elif function_name == "get_info_from_category":
-                    result = await get_info_from_category(int(arguments["category_id"]), user_id, context)
-                elif function_name == "get_random_info_about_world":
-                    result = get_random_info_about_world()
-                elif function_name == "get_user_purchase_history":
-                    result = get_user_purchase_history(user_id)
-                else:
-                    result = "Unknown function call."
-
-                general_logger.info(f"Tool {function_name} result: {result}")
-                tool_outputs.append({
-                    "tool_call_id": tool_call.id,
-                    "output": json.dumps(result, ensure_ascii=False)
-                })
-            submit_tool_outputs(client, thread_id, run.id, tool_outputs)
-
+            tool_outputs = await execute_tool_calls(
+                run.required_action.submit_tool_outputs.tool_calls, user_id, context, state
+            )
+            await submit_tool_outputs(client, thread_id, run.id, tool_outputs)
+            # После отправки результатов ответ обычно приходит быстро
+            delay = RUN_POLL_INITIAL_DELAY
         elif run.status in ["cancelling", "cancelled", "failed", "incomplete", "expired"]:
             general_logger.error(f"Run ended with status: {run.status}")
             if hasattr(run, 'last_error') and run.last_error:
                 general_logger.error(f"Last error: {run.last_error}")
             return []  # Возвращаем пустой список сообщений
         elif run.status == "completed":
-            general_logger.info(f"Run completed successfully after {iteration} iterations")
-            general_logger.debug(f"Run costs {run.usage}")
-            # Получаем все сообщения потока
-            messages = client.beta.threads.messages.list(thread_id=thread_id).data
-            general_logger.info(f"Retrieved {len(messages)} messages from thread")
-            for i, msg in enumerate(messages):
-                general_logger.info(f"Message {i+1}: role={msg.role}, content_type={type(msg.content)}")
-            # Фильтруем все подряд идущие с конца сообщения ассистента до первого user
-            assistant_msgs = []
-            for msg in messages:
-                if msg.role == "assistant":
-                    assistant_msgs.append(msg)
-                elif msg.role == "user":
+            general_logger.info("Run completed successfully after %d iterations", iteration)
+            general_logger.debug("Run costs %s", run.usage)
+            state["usage"] = run.usage
+            # Получаем только новые сообщения потока; ответы, пришедшие до обрыва
+            # стрима, уже отмечены как увиденные и лежат в state["messages"]
+            streamed_ids = {msg.id for msg in state["messages"]}
+            fetched = await fetch_new_assistant_messages(client, thread_id)
+            return state["messages"] + [msg for msg in fetched if msg.id not in streamed_ids]
+
+
+async def run_assistant(client, thread_id, assistant_id, user_id, context):
+    """Запускает ассистента на указанном потоке и обрабатывает его ответы."""
+    general_logger.info("Running assistant %s on thread %s", assistant_id, thread_id)
+    state = {
+        "run_id": None,
+        "outputs": {},
+        "messages": [],
+        "started": time.monotonic(),
+        "first_status": None,
+        "tool_time": 0.0,
+        "usage": None,
+    }
+    messages = []
+    try:
+        messages = await drive_run(client, thread_id, assistant_id, user_id, context, state)
+        return messages
+    finally:
+        run_metrics.record_run(user_id, state, ok=bool(messages) and messages is not RUN_ERROR_REPLY)
+
+
+async def drive_run(client, thread_id, assistant_id, user_id, context, state):
+    """Стрим run с переходом на опрос; при превышении RUN_TIMEOUT run отменяется."""
+    try:
+        if RUN_STREAMING:
+            try:
+                return await asyncio.wait_for(
+                    stream_run(client, thread_id, assistant_id, user_id, context, state),
+                    RUN_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                raise
+            except Exception as e:
+                if state["run_id"] is None:
+                    general_logger.warning(f"Streaming недоступен ({e}), переключаюсь на опрос")
+                else:
+                    general_logger.warning(f"Стрим run {state['run_id']} оборвался ({e}), продолжаю опросом")
+        if state["run_id"] is None:
+            run = await client.beta.threads.runs.create(**run_options(thread_id, assistant_id))
+            state["run_id"] = run.id
+        else:
+            run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=state["run_id"])
+        return await asyncio.wait_for(poll_run(client, thread_id, run, user_id, context, state), RUN_TIMEOUT)
+    except asyncio.TimeoutError:
+        general_logger.error(f"Run for thread {thread_id} exceeded {RUN_TIMEOUT} seconds, cancelling.")
+        if state["run_id"]:
+            try:
+                await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=state["run_id"])
+            except Exception as e:
+                general_logger.error(f"Error cancelling run: {e}")
+        return RUN_ERROR_REPLY
+
+
+# ------------------------------------------------------------------------------
+# Очередь запусков ассистента
+# ------------------------------------------------------------------------------
+# Сколько run ассистента может идти одновременно по всем игрокам
+MAX_CONCURRENT_RUNS = 10
+# Сколько ждём новых сообщений игрока перед запуском run (сообщения склеиваются)
+MESSAGE_COALESCE_DELAY = 0.0
+
+
+class RunScheduler:
+    """Не больше одного run на игрока и не больше max_concurrent run всего.
+
+    Сообщения, пришедшие, пока run игрока ждёт слота или выполняется, копятся
+    и обрабатываются одним следующим run. Слоты раздаются строго по очереди
+    (FIFO), у каждого игрока в очереди не больше одного места.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_RUNS, coalesce_delay=MESSAGE_COALESCE_DELAY):
+        self.max_concurrent = max_concurrent
+        self.coalesce_delay = coalesce_delay
+        self.in_flight = 0
+        self._slot_waiters = deque()
+        # chat_id -> (список апдейтов, future с результатом их обработки)
+        self._pending = {}
+        self._workers = {}
+        self.stats = {
+            "messages": 0,
+            "runs": 0,
+            "coalesced": 0,
+            "max_queue_depth": 0,
+            "queue_wait_total": 0.0,
+        }
+
+    def submit(self, chat_id, update, process):
+        """Ставит сообщение в очередь игрока; future завершится после его обработки.
+
+        process(chat_id, updates) — корутина, которая обрабатывает пачку сообщений.
+        """
+        self.stats["messages"] += 1
+        if chat_id in self._pending:
+            updates, done = self._pending[chat_id]
+            updates.append(update)
+            self.stats["coalesced"] += 1
+        else:
+            done = asyncio.get_running_loop().create_future()
+            self._pending[chat_id] = ([update], done)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id, process))
+        return done
+
+    async def join(self):
+        """Ждёт, пока обработаются все поставленные сообщения."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    def metrics(self):
+        return dict(
+            self.stats,
+            in_flight=self.in_flight,
+            queue_depth=len(self._slot_waiters),
+            pending_chats=len(self._pending),
+        )
+
+    async def _worker(self, chat_id, process):
+        try:
+            while chat_id in self._pending:
+                if self.coalesce_delay:
+                    await asyncio.sleep(self.coalesce_delay)
+                queued_at = time.monotonic()
+                await self._acquire()
+                waited = time.monotonic() - queued_at
+                self.stats["queue_wait_total"] += waited
+                run_metrics.observe("queue", waited)
+                updates, done = self._pending.pop(chat_id)
+                self.stats["runs"] += 1
+                try:
+                    await process(chat_id, updates)
+                    done.set_result(None)
+                except Exception as e:
+                    general_logger.error(f"Ошибка при обработке сообщений чата {chat_id}: {e}")
+                    done.set_exception(e)
+                finally:
+                    self._release()
+        finally:
+            self._workers.pop(chat_id, None)
+
+    async def _acquire(self):
+        if self.in_flight < self.max_concurrent and not self._slot_waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._slot_waiters.append(waiter)
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._slot_waiters))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            elif waiter in self._slot_waiters:
+                self._slot_waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        # Слот переходит следующему в очереди, не освобождаясь
+        while self._slot_waiters:
+            waiter = self._slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+run_scheduler = RunScheduler()
+
+
+# ------------------------------------------------------------------------------
+# Исходящие сообщения
+# ------------------------------------------------------------------------------
+# Телеграм не принимает сообщения длиннее 4096 символов (UTF-16)
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Лимиты Телеграма: около 30 сообщений в секунду на бота и 1 в секунду в чат (короткие всплески допустимы).
+# За любую секунду ведро выдаёт до burst + rate токенов, поэтому оставляем запас
+SEND_GLOBAL_RATE = 25
+SEND_GLOBAL_BURST = 3
+SEND_CHAT_RATE = 1.0
+SEND_CHAT_BURST = 2
+# Сколько раз повторять отправку при сетевых ошибках и RetryAfter
+SEND_RETRIES = 3
+SEND_RETRY_DELAY = 0.5
+# Сколько при остановке ждём отправки накопленных сообщений, с
+SEND_DRAIN_TIMEOUT = 30
+# Сколько вёдер чатов держать, прежде чем выбросить полные
+SEND_BUCKETS_PRUNE = 1000
+# Чем склеиваются подряд идущие сообщения одного чата
+SEND_SEPARATOR = "\n\n"
+
+# Разметка ответов ассистента в HTML Телеграма; применяется к уже экранированному тексту
+MESSAGE_CONVERTERS = (
+    # Теги, которые ассистент пишет сам
+    (re.compile(r"&lt;(/?(?:b|strong|i|em|u|s|code|pre))&gt;"), r"<\1>"),
+    (re.compile(r"\*\*(.+?)\*\*"), r"<b>\1</b>"),
+    (re.compile(r"^#{1,6}[ \t]+(.+)$", re.M), r"<b>\1</b>"),
+    (re.compile(r"`([^`\n]+)`"), r"<code>\1</code>"),
+)
+HTML_TAG = re.compile(r"<[^>]*>")
+# Тег, сущность, перевод строки, пробелы, слово или одиночный символ — резать можно только между ними
+HTML_ATOM = re.compile(r"<(/?)([a-zA-Z]+)[^>]*>|&#?\w+;|\n|[^\S\n]+|[^<&\s]+|[<&]")
+
+
+def format_assistant_text(text):
+    """Markdown ассистента -> HTML Телеграма; остальной текст экранируется."""
+    text = html.escape(text, quote=False)
+    for pattern, replacement in MESSAGE_CONVERTERS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def telegram_length(text):
+    """Длина в единицах UTF-16 — так считает лимит Телеграм."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_html(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Режет HTML на части не длиннее limit.
+
+    Режем по последнему переводу строки, если он во второй половине части,
+    иначе между словами; теги и сущности не разрываются. Открытые теги
+    закрываются в конце части и открываются заново в начале следующей.
+    """
+    if telegram_length(text) <= limit:
+        return [text]
+    chunks = []
+    current, size = "", 0
+    open_tags = []
+    # (позиция в current, размер до неё, открытые там теги) — после последнего перевода строки
+    line_break = None
+    step = max(limit // 4, 1)
+
+    def cut(position, tags):
+        nonlocal current, size
+        head, rest = current[:position].rstrip(), current[position:].lstrip()
+        if HTML_TAG.sub("", head).strip():
+            chunks.append(head + "".join(f"</{name}>" for name, _ in reversed(tags)))
+        current = "".join(tag for _, tag in tags) + rest
+        size = telegram_length(current)
+
+    for match in HTML_ATOM.finditer(text):
+        atom, closing, name = match.group(), match.group(1), match.group(2)
+        pieces = [atom] if name or len(atom) <= step else [atom[i:i + step] for i in range(0, len(atom), step)]
+        for piece in pieces:
+            tags = open_tags
+            if name and closing:
+                names = [tag_name for tag_name, _ in open_tags]
+                if name.lower() in names:
+                    index = len(names) - 1 - names[::-1].index(name.lower())
+                    tags = open_tags[:index] + open_tags[index + 1:]
+            elif name:
+                tags = open_tags + [(name.lower(), piece)]
+            piece_size = telegram_length(piece)
+            if size + piece_size + sum(len(tag_name) + 3 for tag_name, _ in tags) > limit:
+                if line_break and line_break[1] > limit // 2:
+                    cut(line_break[0], line_break[2])
+                else:
+                    cut(len(current), open_tags)
+                line_break = None
+                if piece.isspace():
+                    continue
+            current += piece
+            size += piece_size
+            open_tags = tags
+            if piece == "\n":
+                line_break = (len(current), size, list(open_tags))
+    if HTML_TAG.sub("", current).strip():
+        chunks.append(current.rstrip())
+    return chunks
+
+
+def retry_after_seconds(error):
+    # В зависимости от настроек PTB retry_after — число секунд или timedelta
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, не больше burst подряд.
+
+    reserve() сразу забирает токен (баланс может уйти в минус) и возвращает,
+    сколько ждать своей очереди, — конкуренты получают разные задержки и не
+    просыпаются толпой.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds):
+        """Ничего не выдавать ближайшие seconds секунд (после RetryAfter)."""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class SendQueue:
+    """Очередь исходящих сообщений с учётом лимитов Телеграма.
+
+    У каждого чата своя очередь и своё ведро токенов, плюс общее ведро бота.
+    Длинные тексты режутся split_html; сообщения, накопившиеся в очереди чата,
+    пока она ждала токена, уходят одним сообщением, если влезают в лимит.
+    На RetryAfter чат замолкает на указанное время, и отправка повторяется.
+    """
+
+    def __init__(self, rate=SEND_GLOBAL_RATE, burst=SEND_GLOBAL_BURST,
+                 chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.global_bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._buckets = {}
+        # chat_id -> deque[(текст, длина, future или None)]
+        self._pending = {}
+        self._workers = {}
+        self.stats = {
+            "messages": 0,
+            "sent": 0,
+            "merged": 0,
+            "split": 0,
+            "retry_after": 0,
+            "failed": 0,
+        }
+
+    def send(self, bot, chat_id, text):
+        """Ставит HTML-текст в очередь чата.
+
+        Возвращает future: True, когда ушла последняя часть, False, если доставить не удалось.
+        """
+        done = asyncio.get_running_loop().create_future()
+        chunks = split_html(text)
+        self.stats["messages"] += 1
+        self.stats["split"] += len(chunks) - 1
+        pending = self._pending.setdefault(chat_id, deque())
+        for i, chunk in enumerate(chunks):
+            pending.append((chunk, telegram_length(chunk), done if i == len(chunks) - 1 else None))
+        if chat_id not in self._workers:
+            self._prune_buckets()
+            self._workers[chat_id] = asyncio.create_task(self._worker(bot, chat_id))
+        return done
+
+    def share_global_rate(self, processes):
+        """Общий лимит бота делится поровну между процессами (режим --workers).
+
+        Вёдра чатов не меняются: все сообщения чата отправляет один воркер.
+        """
+        self.global_bucket = TokenBucket(self.rate / processes, self.burst / processes)
+
+    async def join(self):
+        """Ждёт, пока уйдут все поставленные сообщения."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    def metrics(self):
+        return dict(
+            self.stats,
+            pending_chats=len(self._pending),
+            pending_messages=sum(len(pending) for pending in self._pending.values()),
+        )
+
+    async def _worker(self, bot, chat_id):
+        pending = self._pending[chat_id]
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        try:
+            while pending:
+                for limiter in (bucket, self.global_bucket):
+                    delay = limiter.reserve()
+                    if delay:
+                        await asyncio.sleep(delay)
+                text, waiters = self._next_batch(pending)
+                delivered = await self._deliver(bot, chat_id, text, bucket)
+                if not delivered:
+                    self.stats["failed"] += 1
+                for done in waiters:
+                    if done and not done.done():
+                        done.set_result(delivered)
+        finally:
+            self._drop(pending)
+            self._pending.pop(chat_id, None)
+            self._workers.pop(chat_id, None)
+
+    def _next_batch(self, pending):
+        text, size, done = pending.popleft()
+        waiters = [done]
+        while pending and size + len(SEND_SEPARATOR) + pending[0][1] <= TELEGRAM_MESSAGE_LIMIT:
+            more, more_size, more_done = pending.popleft()
+            text += SEND_SEPARATOR + more
+            size += len(SEND_SEPARATOR) + more_size
+            waiters.append(more_done)
+            self.stats["merged"] += 1
+        return text, waiters
+
+    async def _deliver(self, bot, chat_id, text, bucket):
+        parse_mode = "HTML"
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                self.stats["sent"] += 1
+                return True
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self.stats["retry_after"] += 1
+                general_logger.warning(f"Телеграм просит подождать {delay} с перед отправкой в чат {chat_id}")
+                # Ответ 429 может относиться и к лимиту всего бота: держим паузу
+                # для всех чатов, а не только для этого
+                for limiter in (bucket, self.global_bucket):
+                    limiter.pause(delay)
+                for limiter in (bucket, self.global_bucket):
+                    await asyncio.sleep(limiter.reserve())
+            except Forbidden as e:
+                # Игрок заблокировал бота — остальное ему тоже не уйдёт
+                general_logger.warning(f"Не могу писать в чат {chat_id}: {e}")
+                self._drop(self._pending[chat_id])
+                return False
+            except BadRequest as e:
+                if parse_mode is None or "parse entities" not in str(e):
+                    general_logger.error(f"Телеграм отклонил сообщение для чата {chat_id}: {e}")
+                    return False
+                # Разметка ассистента оказалась невалидной — отправляем как обычный текст
+                general_logger.warning(f"Не удалось разобрать HTML для чата {chat_id}, отправляю без разметки: {e}")
+                text = html.unescape(HTML_TAG.sub("", text))
+                parse_mode = None
+            except NetworkError as e:
+                general_logger.warning(f"Сетевая ошибка при отправке в чат {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(SEND_RETRY_DELAY * 2 ** attempt)
+            except Exception as e:
+                general_logger.error(f"Ошибка при отправке в чат {chat_id}: {e}")
+                return False
+        general_logger.error(f"Не удалось отправить сообщение в чат {chat_id} за {SEND_RETRIES + 1} попыток")
+        return False
+
+    @staticmethod
+    def _drop(pending):
+        while pending:
+            _, _, done = pending.popleft()
+            if done and not done.done():
+                done.set_result(False)
+
+    def _prune_buckets(self):
+        if len(self._buckets) < SEND_BUCKETS_PRUNE:
+            return
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._workers and bucket.full()]:
+            del self._buckets[chat_id]
+
+
+send_queue = SendQueue()
+
+
+# ------------------------------------------------------------------------------
+# Метрики
+# ------------------------------------------------------------------------------
+# Границы корзин гистограмм задержек, с
+METRICS_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+# По скольким последним значениям считаются перцентили
+METRICS_RECENT = 1000
+# Как часто писать JSON-дамп метрик (--metrics_file), с
+METRICS_DUMP_INTERVAL = 60
+# Сколько игроков и часов держать в разбивке (самые давние вытесняются)
+METRICS_MAX_USERS = 1000
+METRICS_MAX_HOURS = 7 * 24
+RUN_STAGES = ("queue", "first_status", "tools", "total")
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=METRICS_RECENT)
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def quantile(self, q):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "max": round(self.max, 4),
+            "p50": round(self.quantile(0.5), 4),
+            "p95": round(self.quantile(0.95), 4),
+            "p99": round(self.quantile(0.99), 4),
+            "buckets": self.buckets,
+        }
+
+
+class RunMetrics:
+    """Задержки и расход токенов run'ов: всего, по игрокам и по часам игры.
+
+    Стадии: queue — ожидание слота в RunScheduler, first_status — от запуска run
+    до первого статуса, tools — выполнение инструментов, total — весь run.
+    Время инструментов по отдельности берётся из tool_timings.
+
+    Игроки в разбивке per_user записаны не chat_id, а ключом HMAC с солью
+    процесса (user_key); соответствие ключа игроку пишется только в лог игрока.
+    """
+
+    def __init__(self):
+        self.stages = {stage: Histogram() for stage in RUN_STAGES}
+        self.runs = {"ok": 0, "failed": 0}
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.per_user = OrderedDict()
+        self.per_hour = OrderedDict()
+        self._salt = secrets.token_bytes(16)
+
+    def observe(self, stage, value):
+        self.stages[stage].observe(value)
+
+    def record_run(self, user_id, state, ok):
+        total = time.monotonic() - state["started"]
+        self.observe("total", total)
+        if state["first_status"] is not None:
+            self.observe("first_status", state["first_status"])
+        self.observe("tools", state["tool_time"])
+        self.runs["ok" if ok else "failed"] += 1
+        usage = state["usage"]
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        completion = getattr(usage, "completion_tokens", 0) or 0
+        self.tokens["prompt"] += prompt
+        self.tokens["completion"] += completion
+        user_key = self.user_key(user_id)
+        if user_key not in self.per_user:
+            get_user_logger(user_id).info("Ключ игрока в метриках: %s", user_key)
+        for bucket in (self._bucket(self.per_user, user_key, METRICS_MAX_USERS),
+                       self._bucket(self.per_hour, time.strftime("%Y-%m-%d %H:00"), METRICS_MAX_HOURS)):
+            bucket["runs"] = bucket.get("runs", 0) + 1
+            bucket["failed"] = bucket.get("failed", 0) + (not ok)
+            bucket["latency"] = round(bucket.get("latency", 0.0) + total, 4)
+            bucket["prompt_tokens"] = bucket.get("prompt_tokens", 0) + prompt
+            bucket["completion_tokens"] = bucket.get("completion_tokens", 0) + completion
+
+    def user_key(self, user_id):
+        return hmac.new(self._salt, str(user_id).encode("utf-8"), "sha256").hexdigest()[:12]
+
+    def _bucket(self, buckets, key, limit):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= limit:
+                buckets.popitem(last=False)
+            bucket = buckets[key] = {}
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def snapshot(self):
+        return {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "runs": dict(self.runs),
+            "tokens": dict(self.tokens),
+            "stages": {stage: histogram.to_json() for stage, histogram in self.stages.items()},
+            "tools": {name: dict(timing) for name, timing in tool_timings.items()},
+            "scheduler": run_scheduler.metrics(),
+            "send_queue": send_queue.metrics(),
+            "per_user": self.per_user,
+            "per_hour": self.per_hour,
+        }
+
+    def prometheus(self):
+        """Метрики в текстовом формате Prometheus (без разбивки по игрокам)."""
+        lines = ["# TYPE shifttrader_run_seconds histogram"]
+        for stage, histogram in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + ("+Inf",), histogram.buckets):
+                cumulative += count
+                lines.append(f'shifttrader_run_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'shifttrader_run_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'shifttrader_run_seconds_count{{stage="{stage}"}} {histogram.count}')
+        lines.append("# TYPE shifttrader_runs_total counter")
+        for status, count in self.runs.items():
+            lines.append(f'shifttrader_runs_total{{status="{status}"}} {count}')
+        lines.append("# TYPE shifttrader_tokens_total counter")
+        for kind, count in self.tokens.items():
+            lines.append(f'shifttrader_tokens_total{{kind="{kind}"}} {count}')
+        lines.append("# TYPE shifttrader_tool_seconds summary")
+        for name, timing in tool_timings.items():
+            lines.append(f'shifttrader_tool_seconds_sum{{tool="{name}"}} {timing["total"]}')
+            lines.append(f'shifttrader_tool_seconds_count{{tool="{name}"}} {timing["calls"]}')
+        lines.append("# TYPE shifttrader_scheduler gauge")
+        for key, value in run_scheduler.metrics().items():
+            lines.append(f'shifttrader_scheduler{{metric="{key}"}} {value}')
+        lines.append("# TYPE shifttrader_send_queue gauge")
+        for key, value in send_queue.metrics().items():
+            lines.append(f'shifttrader_send_queue{{metric="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+run_metrics = RunMetrics()
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                405: "Method Not Allowed", 408: "Request Timeout", 413: "Payload Too Large",
+                503: "Service Unavailable"}
+# Сколько ждём заголовков и тела запроса, с
+HTTP_READ_TIMEOUT = 10
+# Сколько держим открытым соединение без запросов, с
+HTTP_IDLE_TIMEOUT = 60
+# Максимальный размер тела запроса (апдейты Телеграма намного меньше)
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_MAX_HEADERS = 100
+
+
+async def serve_http(host, port, handle, check=None, max_body=HTTP_MAX_BODY):
+    """Минимальный HTTP/1.1-сервер на asyncio с keep-alive.
+
+    handle(method, path, headers, body) -> (status, content_type, payload: bytes).
+    check(method, path, headers) -> статус ошибки или None — вызывается до чтения
+    тела, так что неавторизованный клиент не заставит читать и хранить тело.
+    Тело больше max_body отклоняется с 413, медленный клиент отключается по таймауту.
+    """
+    async def read_headers(reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= HTTP_MAX_HEADERS:
+                raise ValueError("слишком много заголовков")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    async def on_client(reader, writer):
+        def respond(status, content_type="text/plain", payload=b"", keep_alive=False):
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+            )
+
+        try:
+            while True:
+                # Нового запроса ждём дольше, чем продолжения начатого
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                try:
+                    headers = await asyncio.wait_for(read_headers(reader), HTTP_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    respond(408)
+                    await writer.drain()
+                    break
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    respond(400)
+                    break
+                status = check(method, path, headers) if check else None
+                if status is None and length > max_body:
+                    status = 413
+                if status is not None:
+                    # Тело не читаем, поэтому соединение дальше использовать нельзя
+                    respond(status)
+                    await writer.drain()
                     break
-            # Отправим их в обратном порядке (от старого к новому)
-            assistant_msgs = list(reversed(assistant_msgs))
-            return assistant_msgs
-    return []
+                try:
+                    body = await asyncio.wait_for(reader.readexactly(length), HTTP_READ_TIMEOUT) if length else b""
+                except asyncio.TimeoutError:
+                    respond(408)
+                    await writer.drain()
+                    break
+                try:
+                    status, content_type, payload = await handle(method, path, headers, body)
+                except Exception as e:
+                    general_logger.error(f"Ошибка при обработке HTTP-запроса {method} {path}: {e}")
+                    status, content_type, payload = 400, "text/plain", b""
+                keep_alive = headers.get("connection", "").lower() != "close"
+                respond(status, content_type, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_client, host, port)
+
+
+async def handle_metrics_request(method, path, headers, body):
+    if method != "GET":
+        return 405, "text/plain", b""
+    if path == "/metrics":
+        return 200, "text/plain; version=0.0.4", run_metrics.prometheus().encode("utf-8")
+    if path == "/metrics.json":
+        return 200, "application/json", json.dumps(run_metrics.snapshot(), ensure_ascii=False).encode("utf-8")
+    return 404, "text/plain", b""
+
+
+def dump_metrics(file_path):
+    """Атомарно записывает JSON-снапшот метрик."""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(run_metrics.snapshot(), f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, file_path)
+
+
+async def dump_metrics_periodically(file_path, interval=METRICS_DUMP_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(dump_metrics, file_path)
+        except Exception as e:
+            general_logger.error(f"Не удалось записать метрики в {file_path}: {e}")
+
+
+def print_metrics_report(file_path):
+    """Краткий отчёт по JSON-дампу метрик (--metrics_report)."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    runs = snapshot["runs"]
+    print(f"Метрики на {snapshot['time']}: run успешно {runs['ok']}, с ошибкой {runs['failed']}, "
+          f"токенов {snapshot['tokens']['prompt']} prompt / {snapshot['tokens']['completion']} completion")
+    print()
+    print(f"{'Стадия':<14}{'кол-во':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'макс':>9}")
+    for stage, histogram in snapshot["stages"].items():
+        print(f"{stage:<14}{histogram['count']:>8}{histogram['p50']:>9.2f}{histogram['p95']:>9.2f}"
+              f"{histogram['p99']:>9.2f}{histogram['max']:>9.2f}")
+    print()
+    print(f"{'Инструмент':<30}{'вызовов':>8}{'ошибок':>8}{'среднее, мс':>13}{'макс, мс':>10}")
+    for name, timing in sorted(snapshot["tools"].items(), key=lambda kv: -kv[1]["total"]):
+        print(f"{name:<30}{timing['calls']:>8}{timing['errors']:>8}"
+              f"{timing['total'] / max(timing['calls'], 1) * 1000:>13.1f}{timing['max'] * 1000:>10.1f}")
+    print()
+    print(f"{'Час':<18}{'run':>6}{'ошибок':>8}{'ср. задержка, с':>17}{'токенов':>10}")
+    for hour, bucket in sorted(snapshot["per_hour"].items()):
+        print(f"{hour:<18}{bucket['runs']:>6}{bucket['failed']:>8}{bucket['latency'] / bucket['runs']:>17.2f}"
+              f"{bucket['prompt_tokens'] + bucket['completion_tokens']:>10}")
+    print()
+    print("Игроки с наибольшим расходом токенов (ключ ищите в logs/user_*.log):")
+    top = sorted(snapshot["per_user"].items(),
+                 key=lambda kv: -(kv[1]["prompt_tokens"] + kv[1]["completion_tokens"]))[:10]
+    for user_key, bucket in top:
+        print(f"  {user_key}: {bucket['runs']} run, {bucket['prompt_tokens'] + bucket['completion_tokens']} токенов, "
+              f"ср. задержка {bucket['latency'] / bucket['runs']:.2f} с")
 
 
 # ------------------------------------------------------------------------------
 # Handlers для Телеграма
 # ------------------------------------------------------------------------------
+def reply(update, context, text):
+    """Ответ в чат апдейта через send_queue: те же лимиты и тот же порядок, что у ответов ассистента.
+
+    text — уже готовый HTML (динамические части экранирует вызывающий).
+    """
+    return send_queue.send(context.bot, str(update.effective_chat.id), text)
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start."""
     chat_id = str(update.effective_chat.id)
     user = get_user(chat_id)
 
     if not user:
-        await update.message.reply_text(
-            """
+        reply(update, context, """
 Для игроков:
 Это ТГ бот для игры Shift, к нему прикручен ИИ, умеет продавать и покупать игровую информацию. Пожалуйста, не пытайтесь его сломать "по жизни", в случае возникновения технических проблем - напишите Басу. Он полностью игровой, общайтесь с ним как человеком (в реальности игры он "отыгрывает" персонажа).
 ❗️Убедительная просьба - ни в коем случае не пытайтесь продать ему информацию, которая не относится к нашей ролевой игре: "пожизнёвую", с других игр, из книг и так далее. Нарушение этого правила карается МГ.
@@ -423,39 +3028,14 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return WAITING_FOR_NAME
     else:
-        user_logger = get_user_logger(chat_id, user["name"])
-        user_logger.info(f"Пользователь {user['name']} запустил бота")
-        await update.message.reply_text(
-            f"С возвращением, {user['name']}!",
-            parse_mode='HTML'
-        )
+        user_logger = get_user_logger(chat_id)
+        user_logger.info(f"Пользователь {user.name} запустил бота")
+        reply(update, context, f"С возвращением, {html.escape(user.name)}!")
 
-        # Проверяем, есть ли у пользователя поток (thread_id)
-        client = context.application.bot_data["openai_client"]
-        if not user.get("thread_id"):
-            # Создаём новый поток
-            thread = client.beta.threads.create()
-            user["thread_id"] = thread.id
-            save_data(USERS_FILE, users)
-            user_logger.info("Создан новый поток (thread) для пользователя")
-            await update.message.reply_text("Создал новый поток (thread) для вашего пользователя.", parse_mode='HTML')
-        else:
-            # Пробуем получить существующий поток
-            try:
-                thread = client.beta.threads.retrieve(thread_id=user["thread_id"])
-                user_logger.info("Продолжение общения в существующем потоке")
-                await update.message.reply_text("Продолжаем общение в существующем потоке.", parse_mode='HTML')
-            except Exception as e:
-                general_logger.error(f"Не удалось получить существующий поток: {e}")
-                # Создаём новый поток, если старый недоступен
-                thread = client.beta.threads.create()
-                user["thread_id"] = thread.id
-                save_data(USERS_FILE, users)
-                user_logger.info("Создан новый поток из-за недоступности старого")
-                await update.message.reply_text("Создал новый поток, так как старый недоступен.", parse_mode='HTML')
+        # Поток (thread) создаётся и проверяется при первом сообщении — см. ThreadManager
 
         # Выводим баланс
-        await update.message.reply_text(f"Ваш баланс: {user['balance']} кредитов. Привет, я Меняла, у меня есть всякая информация, её можно купить. А можно продать свою. Просто начни разговор.", parse_mode='HTML')
+        reply(update, context, f"Ваш баланс: {user.balance} кредитов. Привет, я Меняла, у меня есть всякая информация, её можно купить. А можно продать свою. Просто начни разговор.")
         return ConversationHandler.END
 
 
@@ -465,31 +3045,134 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.text.strip()
     
     if len(name) < 2:
-        await update.message.reply_text("Имя должно содержать минимум 2 символа. Попробуйте еще раз:", parse_mode='HTML')
+        reply(update, context, "Имя должно содержать минимум 2 символа. Попробуйте еще раз:")
         return WAITING_FOR_NAME
     
-    user = create_user(chat_id, name)
-    user_logger = get_user_logger(chat_id, name)
+    user = await call_with_storage_retry(create_user, chat_id, name)
+    user_logger = get_user_logger(chat_id)
     user_logger.info(f"Создан новый пользователь с именем {name}")
     
-    await update.message.reply_text(
-        f"Отлично, {name}! Я создал для вас нового пользователя.",
-        parse_mode='HTML'
-    )
-    
-    # Создаём новый поток
-    client = context.application.bot_data["openai_client"]
-    thread = client.beta.threads.create()
-    user["thread_id"] = thread.id
-    save_data(USERS_FILE, users)
-    user_logger.info("Создан новый поток (thread) для пользователя")
-    
-    await update.message.reply_text("Создал новый поток (thread) для вашего пользователя.", parse_mode='HTML')
-    await update.message.reply_text(f"Ваш баланс: {user['balance']} кредитов.", parse_mode='HTML')
+    reply(update, context, f"Отлично, {html.escape(name)}! Я создал для вас нового пользователя.")
+
+    reply(update, context, f"Ваш баланс: {user.balance} кредитов.")
     
     return ConversationHandler.END
 
 
+# ------------------------------------------------------------------------------
+# Быстрые команды: отвечают из памяти, без запуска ассистента
+# ------------------------------------------------------------------------------
+def command_args(context):
+    """Целочисленные аргументы команды; None, если какой-то аргумент не число."""
+    try:
+        return [int(arg) for arg in context.args or []]
+    except ValueError:
+        return None
+
+
+async def fast_command_user(update, context):
+    """Игрок, вызвавший быструю команду, или None (тогда уже попросили /start)."""
+    user = get_user(str(update.effective_chat.id))
+    if not user:
+        reply(update, context, "Для начала введите /start")
+    return user
+
+
+async def cmd_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /balance."""
+    user = await fast_command_user(update, context)
+    if not user:
+        return
+    chat_id = str(update.effective_chat.id)
+    thread_notes.add(chat_id, f"посмотрел баланс (/balance): {user.balance} кредитов")
+    reply(update, context, f"Ваш баланс: {user.balance} кредитов.")
+
+
+async def cmd_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /categories."""
+    if not await fast_command_user(update, context):
+        return
+    chat_id = str(update.effective_chat.id)
+    lines = [f"{c['id']}. {html.escape(c['name'])} — записей: {c['count']}" for c in get_categories_with_counts()]
+    thread_notes.add(chat_id, "посмотрел список категорий (/categories)")
+    reply(update, context, "<b>Категории</b>\n" + "\n".join(lines) + "\n\nСписок записей: /items &lt;категория&gt;")
+
+
+async def cmd_items(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /items <категория> [с какого id]."""
+    if not await fast_command_user(update, context):
+        return
+    args = command_args(context)
+    if not args or len(args) > 2:
+        reply(update, context, "Использование: /items &lt;категория&gt; [с какого id]")
+        return
+    chat_id = str(update.effective_chat.id)
+    category_id = args[0]
+    page = handle_show_items(category_id, args[1] if len(args) > 1 else None)
+    if isinstance(page, str):
+        reply(update, context, html.escape(page))
+        return
+    if not page.records:
+        reply(update, context, "В этой категории пока нет информации.")
+        return
+    lines = [
+        f"{r['id']}. {html.escape(r['description'][:TOOL_FIELD_LIMIT])} — {r['cost']} {html.escape(r['cost_name'])}"
+        for r in page.records
+    ]
+    if page.next_cursor is not None:
+        lines.append(f"\nДальше: /items {category_id} {page.next_cursor}")
+    lines.append(f"Купить: /buy {category_id} &lt;id&gt;")
+    thread_notes.add(chat_id, f"посмотрел записи категории {category_id} (/items), id {page.cursors[0]}–{page.cursors[-1]}")
+    reply(update, context, "\n".join(lines))
+
+
+async def cmd_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /buy <категория> <id>."""
+    user = await fast_command_user(update, context)
+    if not user:
+        return
+    args = command_args(context)
+    if not args or len(args) != 2:
+        reply(update, context, "Использование: /buy &lt;категория&gt; &lt;id&gt;")
+        return
+    chat_id = str(update.effective_chat.id)
+    category_id, item_id = args
+    result = await call_with_storage_retry(handle_buy_item, chat_id, category_id, item_id)
+    if result.startswith("Информация успешно куплена"):
+        item = catalog.get(category_id, item_id)
+        thread_notes.add(chat_id, f"купил (/buy) информацию «{item.description}» (категория {category_id}, id {item_id}) "
+                                  f"за {item.cost} {item.cost_name}, баланс теперь {user.balance}")
+    else:
+        thread_notes.add(chat_id, f"попытался купить (/buy) информацию {item_id} из категории {category_id}: {result}")
+    reply(update, context, html.escape(result))
+
+
+async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /history [курсор]."""
+    if not await fast_command_user(update, context):
+        return
+    args = command_args(context)
+    if args is None or len(args) > 1:
+        reply(update, context, "Использование: /history [курсор]")
+        return
+    chat_id = str(update.effective_chat.id)
+    page = get_user_purchase_history(chat_id, cursor=args[0] if args else None)
+    if isinstance(page, str):
+        reply(update, context, html.escape(page))
+        return
+    if not page.records:
+        reply(update, context, "Вы пока ничего не покупали.")
+        return
+    lines = [
+        f"{r['category_id']}/{r['id']}. {html.escape(r['description'])} — {r['cost']} {html.escape(r['cost_name'])}"
+        for r in page.records
+    ]
+    if page.next_cursor is not None:
+        lines.append(f"\nДальше: /history {page.next_cursor}")
+    thread_notes.add(chat_id, f"посмотрел историю покупок (/history), записей: {len(page.records)}")
+    reply(update, context, "<b>Ваши покупки</b>\n" + "\n".join(lines))
+
+
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка любого текстового сообщения (не команды)."""
     chat_id = str(update.effective_chat.id)
@@ -497,85 +3180,540 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     if not user:
         # Если пользователь не существует, перенаправляем на /start
-        await update.message.reply_text("Для начала введите /start", parse_mode='HTML')
+        reply(update, context, "Для начала введите /start")
         return
 
-    user_logger = get_user_logger(chat_id, user["name"])
-    user_logger.info(f"Получено сообщение: {update.message.text}")
+    user_logger = get_user_logger(chat_id)
+    user_logger.info("Получено сообщение: %s", update.message.text)
 
-    client = context.application.bot_data["openai_client"]
+    async def process(chat_id, updates):
+        await process_user_messages(chat_id, updates, context)
+
+    await run_scheduler.submit(chat_id, update, process)
 
-    # Добавляем сообщение пользователя в поток
-    add_message_to_thread(
-        client=client,
-        thread_id=user["thread_id"],
-        role="user",
-        content=update.message.text,
-        user_id=chat_id
-    )
+
+async def process_user_messages(chat_id, updates, context):
+    """Добавляет пачку сообщений игрока в поток и отвечает по итогам одного run."""
+    user_logger = get_user_logger(chat_id)
+    if len(updates) > 1:
+        user_logger.info("Склеено %d сообщений в один запуск ассистента", len(updates))
+
+    client = context.application.bot_data["openai_client"]
+    thread_id = await thread_manager.ensure_thread(client, chat_id)
+
+    # Сначала сообщаем ассистенту о быстрых командах, выполненных без него
+    notes = thread_notes.pop(chat_id)
+    if notes:
+        await add_message_to_thread(client=client, thread_id=thread_id, role="user", content=notes, user_id=chat_id)
+
+    # Добавляем сообщения пользователя в поток
+    for queued in updates:
+        await add_message_to_thread(
+            client=client,
+            thread_id=thread_id,
+            role="user",
+            content=queued.message.text,
+            user_id=chat_id
+        )
 
     # Запускаем ассистента
     user_logger.info("Запускаю ассистента...")
     messages = await run_assistant(
         client=client,
-        thread_id=user["thread_id"],
+        thread_id=thread_id,
         assistant_id=ASSISTANT_ID,
         user_id=chat_id,
         context=context
     )
 
     # Подробное логирование результатов
-    user_logger.info(f"Получено {len(messages)} сообщений от ассистента")
+    user_logger.info("Получено %d сообщений от ассистента", len(messages))
     if not messages:
         user_logger.warning("Ассистент вернул пустой список сообщений")
-        await update.message.reply_text("❌ ОШИБКА: Ассистент не смог обработать ваш запрос. Попробуйте еще раз через несколько секунд.", parse_mode='HTML')
+        send_queue.send(context.bot, chat_id, "❌ ОШИБКА: Ассистент не смог обработать ваш запрос. Попробуйте еще раз через несколько секунд.")
         return
 
     # Если вернулся объект с ошибкой
     if isinstance(messages, list) and len(messages) == 1 and isinstance(messages[0], dict) and "error" in messages[0]:
         user_logger.error(messages[0]["error"])
-        await update.message.reply_text(messages[0]["error"], parse_mode='HTML')
+        send_queue.send(context.bot, chat_id, messages[0]["error"])
         return
 
-    # Отправляем все подряд идущие сообщения ассистента (от старого к новому)
+    # Отправляем все подряд идущие сообщения ассистента (от старого к новому);
+    # очередь не держит слот run и склеит их, если влезут в одно сообщение
     for msg in messages:
-        user_logger.info(f"Отправляю ответ пользователю: {msg.content}...")
+        user_logger.info("Отправляю ответ пользователю: %s...", log_payload(msg.content))
         if msg.content and isinstance(msg.content, list):
                 if len(msg.content) > 0:
                     assistant_text = msg.content[0].text.value
-                    user_logger.info(f"Извлечен текст из content[0]: {assistant_text}...")
+                    user_logger.info("Извлечен текст из content[0]: %s...", assistant_text)
                 else:
                     user_logger.warning("content является пустым списком")
+                    continue
         else:
             assistant_text = str(msg.content)
-            user_logger.info(f"Извлечен текст напрямую: {assistant_text}...")
-        
-        # Преобразуем **жирный** в <b>жирный</b> для совместимости
-        text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', assistant_text)
-        await update.message.reply_text(text, parse_mode='HTML')
+            user_logger.info("Извлечен текст напрямую: %s...", assistant_text)
+
+        send_queue.send(context.bot, chat_id, format_assistant_text(assistant_text))
 
 
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка неизвестных команд."""
-    await update.message.reply_text("Извините, я не знаю такой команды.", parse_mode='HTML')
+    reply(update, context, "Извините, я не знаю такой команды.")
+
+
+# ------------------------------------------------------------------------------
+# Webhook
+# ------------------------------------------------------------------------------
+# Сколько при остановке ждём завершения начатых run, с
+SHUTDOWN_DRAIN_TIMEOUT = RUN_TIMEOUT + 10
+
+
+async def drain_runs(application=None):
+    """Дожидается run, которые уже поставлены в очередь или выполняются, и отправки их ответов."""
+    metrics = run_scheduler.metrics()
+    general_logger.info(f"Ожидаю завершения run: в работе {metrics['in_flight']}, ждут {metrics['pending_chats']}")
+    try:
+        await asyncio.wait_for(run_scheduler.join(), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        general_logger.error(f"Не все run завершились за {SHUTDOWN_DRAIN_TIMEOUT} с")
+    try:
+        await asyncio.wait_for(send_queue.join(), SEND_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        general_logger.error(f"Не все сообщения отправлены за {SEND_DRAIN_TIMEOUT} с: {send_queue.metrics()}")
+
+
+class WebhookServer:
+    """Принимает апдейты от Телеграма по HTTP и кладёт их в update_queue приложения.
+
+    Запрос без правильного X-Telegram-Bot-Api-Secret-Token отклоняется с 401
+    ещё до чтения тела (check). После stop() новые апдейты получают 503 —
+    Телеграм повторит их позже.
+    """
+
+    def __init__(self, application, path, secret_token):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.accepting = True
+        self.received = 0
+
+    def check(self, method, path, headers):
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), self.secret_token.encode("utf-8")):
+            general_logger.warning("Webhook: запрос с неверным секретным токеном")
+            return 401
+        if not self.accepting:
+            return 503
+        return None
+
+    async def handle(self, method, path, headers, body):
+        update = Update.de_json(json.loads(body), self.application.bot)
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return 200, "text/plain", b""
+
+    def stop(self):
+        self.accepting = False
+
+
+async def run_webhook(application, url, listen, port, secret_token=None, max_connections=40):
+    """Запускает бота в режиме webhook до SIGINT/SIGTERM, затем мягко останавливает.
+
+    Порядок остановки: перестаём принимать апдейты, дообрабатываем принятые
+    (Application.stop), ждём начатые run (post_stop) и закрываем приложение.
+    """
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    webhook = WebhookServer(application, urlsplit(url).path or "/", secret_token)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def serve():
+        server = await serve_http(listen, port, webhook.handle, webhook.check)
+        try:
+            await application.bot.set_webhook(
+                url=url,
+                secret_token=secret_token,
+                max_connections=max_connections,
+                allowed_updates=Update.ALL_TYPES
+            )
+            general_logger.info(f"Webhook {url} слушает {listen}:{port}")
+            await stop_event.wait()
+            general_logger.info(f"Останавливаю webhook, принято апдейтов: {webhook.received}")
+        finally:
+            webhook.stop()
+            server.close()
+
+    await run_application(application, serve)
+
+
+async def run_application(application, serve):
+    """Жизненный цикл приложения без run_polling.
+
+    initialize, post_init и start, затем serve() — пока не пора остановиться;
+    после него stop (дообработка принятых апдейтов), post_stop, shutdown и post_shutdown.
+    """
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            await serve()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# ------------------------------------------------------------------------------
+# Процессы-воркеры
+# ------------------------------------------------------------------------------
+WORKERS_DIR = "workers"
+# Сколько ждать, пока воркер откроет сокет, с
+WORKER_START_TIMEOUT = 60
+# Сколько ждать завершения воркера после закрытия его сокета, с
+WORKER_STOP_TIMEOUT = SHUTDOWN_DRAIN_TIMEOUT + 30
+# Как часто супервизор проверяет, живы ли воркеры, с
+WORKER_CHECK_INTERVAL = 1.0
+
+
+def worker_socket_path(worker_id):
+    return os.path.join(WORKERS_DIR, f"worker_{worker_id}.sock")
+
+
+def worker_for_chat(chat_id, count):
+    """Номер воркера для чата; в отличие от hash() не меняется между запусками."""
+    return zlib.crc32(str(chat_id).encode("utf-8")) % count
+
+
+class WorkerPool:
+    """Процессы-воркеры супервизора и доставка им апдейтов.
+
+    Все апдейты чата уходят одному воркеру (worker_for_chat) по одному
+    Unix-сокету, поэтому сообщения игрока не обгоняют друг друга, а его
+    баланс, поток и диалог /start живут в одном процессе. Упавший воркер
+    перезапускается (при проверке раз в WORKER_CHECK_INTERVAL или при
+    пересылке ему апдейта); если он не поднимается, пересылка падает с ошибкой.
+    """
+
+    def __init__(self, count, argv):
+        self.count = count
+        self.argv = argv
+        self.processes = [None] * count
+        self.writers = [None] * count
+        self.forwarded = [0] * count
+        self.restarts = [0] * count
+        self._restart_locks = [asyncio.Lock() for _ in range(count)]
+        self._watcher = None
+
+    def start(self):
+        os.makedirs(WORKERS_DIR, exist_ok=True)
+        for worker_id in range(self.count):
+            self._spawn(worker_id)
+
+    def _spawn(self, worker_id):
+        env = dict(os.environ, SHIFTTRADER_STORE=SHARED_STORE_FILE, SHIFTTRADER_WORKER=str(worker_id))
+        # Своя сессия: Ctrl+C получает только супервизор, воркеров он останавливает сам
+        self.processes[worker_id] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), *self.argv, "--worker", str(worker_id)],
+            env=env,
+            start_new_session=True
+        )
+
+    async def connect(self, application=None):
+        for worker_id in range(self.count):
+            await self._connect(worker_id)
+        self._watcher = asyncio.create_task(self._watch())
+        general_logger.info(f"Запущено воркеров: {self.count}")
+
+    async def _connect(self, worker_id):
+        process = self.processes[worker_id]
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while True:
+            try:
+                _, self.writers[worker_id] = await asyncio.open_unix_connection(worker_socket_path(worker_id))
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"Воркер {worker_id} не запустился")
+                await asyncio.sleep(0.2)
+
+    async def _restart(self, worker_id):
+        async with self._restart_locks[worker_id]:
+            process = self.processes[worker_id]
+            if process.poll() is None and self.writers[worker_id] is not None:
+                return
+            general_logger.error(f"Воркер {worker_id} упал (код {process.poll()}), перезапускаю")
+            if process.poll() is None:
+                process.kill()
+                await asyncio.to_thread(process.wait)
+            if self.writers[worker_id] is not None:
+                self.writers[worker_id].close()
+                self.writers[worker_id] = None
+            self.restarts[worker_id] += 1
+            self._spawn(worker_id)
+            await self._connect(worker_id)
+            general_logger.info(f"Воркер {worker_id} перезапущен")
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for worker_id, process in enumerate(self.processes):
+                if process.poll() is not None:
+                    try:
+                        await self._restart(worker_id)
+                    except Exception as e:
+                        general_logger.error(f"Не удалось перезапустить воркер {worker_id}: {e}")
+
+    async def forward(self, update, context):
+        chat = update.effective_chat or update.effective_user
+        worker_id = worker_for_chat(chat.id if chat else update.update_id, self.count)
+        line = json.dumps(update.to_dict(), ensure_ascii=False).encode("utf-8") + b"\n"
+        for attempt in range(2):
+            if self.processes[worker_id].poll() is not None or self.writers[worker_id] is None:
+                await self._restart(worker_id)
+            writer = self.writers[worker_id]
+            try:
+                writer.write(line)
+                await writer.drain()
+                self.forwarded[worker_id] += 1
+                return
+            except ConnectionError as e:
+                general_logger.error(f"Соединение с воркером {worker_id} оборвалось: {e}")
+                writer.close()
+                self.writers[worker_id] = None
+        raise RuntimeError(f"Апдейт {update.update_id} не доставлен воркеру {worker_id}")
+
+    async def stop(self, application=None):
+        """Закрывает сокеты; воркеры дообрабатывают принятое и завершаются."""
+        if self._watcher is not None:
+            self._watcher.cancel()
+        for writer in self.writers:
+            if writer is not None:
+                writer.close()
+        self.writers = [None] * self.count
+        await asyncio.gather(*(asyncio.to_thread(self._wait, worker_id) for worker_id in range(self.count)))
+        general_logger.info(f"Воркеры остановлены, апдейтов передано: {self.forwarded}, перезапусков: {self.restarts}")
+
+    def _wait(self, worker_id):
+        process = self.processes[worker_id]
+        try:
+            process.wait(WORKER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            general_logger.error(f"Воркер {worker_id} не завершился за {WORKER_STOP_TIMEOUT} с, останавливаю")
+            process.kill()
+            process.wait()
+
+
+async def sync_storage_periodically(interval=SHARED_STORE_SYNC_INTERVAL):
+    """Подтягивает изменения других воркеров, чтобы каталог и кэш не отставали."""
+    while True:
+        await asyncio.sleep(interval)
+        await storage.sync_async()
+
+
+async def run_worker(application, worker_id, workers):
+    """Воркер: обрабатывает апдейты от супервизора, пока тот не закроет сокет."""
+    socket_path = worker_socket_path(worker_id)
+    # Лимит Телеграма на бота общий для всех воркеров
+    send_queue.share_global_rate(workers)
+
+    async def serve():
+        disconnected = asyncio.Event()
+
+        async def on_supervisor(reader, writer):
+            try:
+                while line := await reader.readline():
+                    # Перед апдейтом догоняем чужие изменения каталога
+                    await storage.sync_async()
+                    await application.update_queue.put(Update.de_json(json.loads(line), application.bot))
+            finally:
+                writer.close()
+                disconnected.set()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(on_supervisor, socket_path)
+        sync_task = asyncio.create_task(sync_storage_periodically())
+        try:
+            await disconnected.wait()
+            general_logger.info(f"Супервизор закрыл соединение, воркер {worker_id} останавливается")
+        finally:
+            sync_task.cancel()
+            server.close()
+            os.remove(socket_path)
+
+    await run_application(application, serve)
+
+
+def run_supervisor(args):
+    """Режим --workers: супервизор получает апдейты и раздаёт их воркерам по chat_id.
+
+    Воркеры делят данные через SQLite (SHARED_STORE_FILE). Перед стартом журнал
+    сворачивается в JSON-снапшоты, из которых воркеры заполняют базу; после
+    остановки воркеров база выгружается обратно в JSON и удаляется.
+    """
+    if Path(SHARED_STORE_FILE).exists():
+        general_logger.warning(f"{SHARED_STORE_FILE} остался от прерванного запуска, продолжаю с его данными")
+    storage.close()
+
+    pool = WorkerPool(args.workers, sys.argv[1:])
+    pool.start()
+    application = (
+        ApplicationBuilder()
+        .token(args.telegram_token)
+        .post_init(pool.connect)
+        .post_stop(pool.stop)
+        .build()
+    )
+    # Апдейты пересылаются строго по одному, чтобы сообщения чата не обгоняли друг друга
+    application.add_handler(TypeHandler(Update, pool.forward))
+    try:
+        if args.mode == "webhook":
+            asyncio.run(run_webhook(
+                application,
+                url=args.webhook_url,
+                listen=args.webhook_listen,
+                port=args.webhook_port,
+                secret_token=args.webhook_secret,
+                max_connections=args.webhook_max_connections
+            ))
+        else:
+            application.run_polling()
+    finally:
+        for process in pool.processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
+        export_shared_store()
+
+
+def export_shared_store():
+    """Выгружает общее хранилище воркеров в JSON-файлы и удаляет базу."""
+    shared = SqliteStorage(SHARED_STORE_FILE)
+    shared.export()
+    shared.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(SHARED_STORE_FILE + suffix):
+            os.remove(SHARED_STORE_FILE + suffix)
 
 
 # ------------------------------------------------------------------------------
 # Основная точка входа
 # ------------------------------------------------------------------------------
 def main():
+    global LOG_PAYLOADS
     parser = argparse.ArgumentParser()
-    parser.add_argument("--api_key", required=True, help="OpenAI API Key")
-    parser.add_argument("--telegram_token", required=True, help="Telegram Bot Token")
+    parser.add_argument("--api_key", help="OpenAI API Key")
+    parser.add_argument("--telegram_token", help="Telegram Bot Token")
+    parser.add_argument("--max_connections", type=int, default=100, help="Размер пула HTTP-соединений к OpenAI")
+    parser.add_argument("--max_concurrent_runs", type=int, default=MAX_CONCURRENT_RUNS, help="Сколько run ассистента идёт одновременно")
+    parser.add_argument("--coalesce_delay", type=float, default=MESSAGE_COALESCE_DELAY, help="Сколько ждать новых сообщений игрока перед запуском run, с")
+    parser.add_argument("--facts_file", default=INFO_ABOUT_WORLD_FILE, help="Файл с фактами о мире (например, full_info.json)")
+    parser.add_argument("--log_level", default="DEBUG", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Уровень общего лога")
+    parser.add_argument("--log_payloads", default=LOG_PAYLOADS, choices=["full", "short", "none"],
+                        help="Как подробно логировать сообщения и результаты инструментов")
+    parser.add_argument("--mode", default="polling", choices=["polling", "webhook"], help="Как получать апдейты Телеграма")
+    parser.add_argument("--webhook_url", help="Публичный URL webhook, например https://example.com/telegram")
+    parser.add_argument("--webhook_listen", default="0.0.0.0", help="Адрес, на котором слушает webhook-сервер")
+    parser.add_argument("--webhook_port", type=int, default=8443, help="Порт webhook-сервера")
+    parser.add_argument("--webhook_secret", help="Секретный токен webhook (по умолчанию случайный)")
+    parser.add_argument("--webhook_max_connections", type=int, default=40,
+                        help="Сколько соединений Телеграм открывает к webhook (1-100)")
+    parser.add_argument("--concurrent_updates", type=int, default=256, help="Сколько апдейтов обрабатывается одновременно")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Сколько процессов-воркеров запустить (больше 1 — режим супервизора)")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--recover_shared_store", action="store_true",
+                        help=f"Выгрузить {SHARED_STORE_FILE}, оставшийся от прерванного запуска с --workers, в JSON и выйти")
+    parser.add_argument("--metrics_port", type=int, help="Порт HTTP для /metrics (Prometheus) и /metrics.json")
+    parser.add_argument("--metrics_host", default="127.0.0.1",
+                        help="Адрес HTTP-сервера метрик; 0.0.0.0 открывает его всей сети, метрики без авторизации")
+    parser.add_argument("--metrics_file", help="Куда периодически писать JSON-дамп метрик")
+    parser.add_argument("--metrics_report", metavar="FILE", help="Напечатать отчёт по JSON-дампу метрик и выйти")
     args = parser.parse_args()
 
-    # Инициализация клиента OpenAI
-    openai_client = OpenAI(api_key=args.api_key)
+    if args.metrics_report:
+        print_metrics_report(args.metrics_report)
+        return
+    if args.recover_shared_store:
+        export_shared_store()
+        print(f"Данные из {SHARED_STORE_FILE} перенесены в JSON-файлы")
+        return
+    # Данные в базе прерванного запуска с воркерами новее JSON-файлов: супервизор
+    # продолжит с ними, а один процесс их не видит и перезаписал бы
+    if args.worker is None and args.workers <= 1 and Path(SHARED_STORE_FILE).exists():
+        parser.error(f"найден {SHARED_STORE_FILE} от прерванного запуска с --workers; "
+                     f"запустите с --recover_shared_store, чтобы перенести его данные в JSON, или снова с --workers")
+    if not args.api_key or not args.telegram_token:
+        parser.error("--api_key и --telegram_token обязательны")
+    if args.mode == "webhook" and not args.webhook_url:
+        parser.error("для --mode webhook нужен --webhook_url")
+    if args.worker is None and args.workers > 1:
+        run_supervisor(args)
+        return
+    if args.worker is not None:
+        # У каждого воркера свой порт и файл метрик
+        if args.metrics_port:
+            args.metrics_port += args.worker + 1
+        if args.metrics_file:
+            args.metrics_file = per_worker_path(args.metrics_file)
+
+    general_logger.setLevel(args.log_level)
+    LOG_PAYLOADS = args.log_payloads
+    # Сворачиваем журнал, оставшийся с прошлого запуска, чтобы следующий старт был быстрым
+    storage.compact()
+    facts_provider.file_path = args.facts_file
+    run_scheduler.max_concurrent = args.max_concurrent_runs
+    run_scheduler.coalesce_delay = args.coalesce_delay
+
+    # Инициализация клиента OpenAI: один асинхронный клиент с общим пулом соединений
+    openai_client = AsyncOpenAI(
+        api_key=args.api_key,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=args.max_connections,
+                max_keepalive_connections=args.max_connections
+            )
+        )
+    )
 
-    # Создаём приложение Telegram
+    async def start_background_tasks(application):
+        # Полнотекстовый индекс и индекс дублей строятся уже после старта
+        application.bot_data["catalog_index"] = asyncio.create_task(catalog.catch_up())
+        if args.metrics_port:
+            application.bot_data["metrics_server"] = await serve_http(args.metrics_host, args.metrics_port, handle_metrics_request)
+            general_logger.info(f"Метрики доступны на {args.metrics_host}:{args.metrics_port}")
+        if args.metrics_file:
+            application.bot_data["metrics_dump"] = asyncio.create_task(dump_metrics_periodically(args.metrics_file))
+
+    async def close_openai_client(application):
+        await application.bot_data["openai_client"].close()
+        application.bot_data["catalog_index"].cancel()
+        if "metrics_server" in application.bot_data:
+            application.bot_data["metrics_server"].close()
+        if "metrics_dump" in application.bot_data:
+            application.bot_data["metrics_dump"].cancel()
+
+    # Создаём приложение Telegram; апдейты разных чатов обрабатываются параллельно
     application = (
         ApplicationBuilder()
         .token(args.telegram_token)
+        .concurrent_updates(args.concurrent_updates)
+        .post_init(start_background_tasks)
+        .post_stop(drain_runs)
+        .post_shutdown(close_openai_client)
         .build()
     )
 
@@ -593,13 +3731,37 @@ def main():
 
     # Регистрируем хендлеры
     application.add_handler(conv_handler)
+    # Быстрые команды без ассистента
+    application.add_handler(CommandHandler("balance", cmd_balance))
+    application.add_handler(CommandHandler("categories", cmd_categories))
+    application.add_handler(CommandHandler("items", cmd_items))
+    application.add_handler(CommandHandler("buy", cmd_buy))
+    application.add_handler(CommandHandler("history", cmd_history))
     # Текстовые сообщения (не команды)
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text_message))
     # Хендлер для неизвестных команд
     application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
 
     # Запускаем бота
-    application.run_polling()
+    try:
+        if args.worker is not None:
+            asyncio.run(run_worker(application, args.worker, args.workers))
+        elif args.mode == "webhook":
+            asyncio.run(run_webhook(
+                application,
+                url=args.webhook_url,
+                listen=args.webhook_listen,
+                port=args.webhook_port,
+                secret_token=args.webhook_secret,
+                max_connections=args.webhook_max_connections
+            ))
+        else:
+            application.run_polling()
+    finally:
+        # Сворачиваем журнал в снапшоты при остановке
+        storage.close()
+        if args.metrics_file:
+            dump_metrics(args.metrics_file)
 
 
 if __name__ == "__main__":